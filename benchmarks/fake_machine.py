@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the docker-machine binary, printing what docker-machine
+prints for a fleet of synthetic machines without touching any driver.
+
+Configured through environment variables:
+
+    FAKE_MACHINE_COUNT          number of machines (machine-00000...), default 10
+    FAKE_MACHINE_STATE          state of every machine, default Running
+    FAKE_MACHINE_DRIVER         driver of every machine, default virtualbox
+    FAKE_MACHINE_LATENCY        seconds every command sleeps, default 0
+    FAKE_MACHINE_PROBE_LATENCY  seconds `ls` spends per machine listed, default 0
+    FAKE_MACHINE_FAIL           space separated machine names whose commands fail
+    FAKE_MACHINE_FAIL_RATE      probability that a command fails, default 0
+    FAKE_MACHINE_SEED           seed of the failure draws
+    FAKE_MACHINE_STORAGE        storage path shown in paths, default /tmp/fake-machine
+"""
+from __future__ import print_function
+
+import json
+import os
+import random
+import sys
+import time
+
+VERSION = "docker-machine version 0.8.2, build e18a919"
+
+ACTIONS = {
+    "start": ("Starting \"%s\"...", "Machine \"%s\" was started."),
+    "stop": ("Stopping \"%s\"...", "Machine \"%s\" was stopped."),
+    "kill": ("Killing \"%s\"...", "Machine \"%s\" was killed."),
+    "restart": ("Restarting \"%s\"...", "Machine \"%s\" was restarted."),
+    "rm": ("About to remove %s", "Successfully removed %s"),
+    "provision": ("Waiting for SSH to be available on %s...", "Docker is up and running on %s!"),
+    "upgrade": ("Upgrading docker on %s...", "Restarting docker on %s..."),
+    "regenerate-certs": ("Regenerating TLS certificates for %s", "Copying certs to %s"),
+}
+
+
+def env(name, default=None):
+    return os.environ.get("FAKE_MACHINE_" + name, default)
+
+
+def names():
+    return ["machine-%05d" % i for i in range(int(env("COUNT", "10")))]
+
+
+def ip(name):
+    index = int(name.rsplit("-", 1)[-1]) if name.rsplit("-", 1)[-1].isdigit() else 0
+    return "10.%d.%d.%d" % (index // 65536 % 256, index // 256 % 256, index % 256 + 1)
+
+
+def storage():
+    return env("STORAGE", "/tmp/fake-machine")
+
+
+def failing(name):
+    if name in env("FAIL", "").split():
+        return True
+    rate = float(env("FAIL_RATE", "0"))
+    return rate > 0 and random.random() < rate
+
+
+def fail(message, code=1):
+    sys.stderr.write(message + "\n")
+    sys.exit(code)
+
+
+def row(name):
+    return {
+        "Name": name,
+        "Active": "-",
+        "ActiveHost": "false",
+        "ActiveSwarm": "false",
+        "DriverName": env("DRIVER", "virtualbox"),
+        "State": env("STATE", "Running"),
+        "URL": "tcp://%s:2376" % ip(name),
+        "Swarm": "",
+        "Error": "",
+        "DockerVersion": "v1.12.3",
+        "ResponseTime": "%.4fms" % (random.random() * 20),
+    }
+
+
+def template(fmt, values):
+    for key, value in values.items():
+        fmt = fmt.replace("{{.%s}}" % key, value)
+    return fmt.replace("\\t", "\t")
+
+
+def ls(args):
+    fmt, filters, quiet = None, [], False
+    i = 0
+    while i < len(args):
+        if args[i] in ("-f", "--format"):
+            fmt = args[i + 1]
+            i += 1
+        elif args[i] == "--filter":
+            filters.append(args[i + 1].split("=", 1))
+            i += 1
+        elif args[i] in ("-t", "--timeout"):
+            i += 1
+        elif args[i] in ("-q", "--quiet"):
+            quiet = True
+        i += 1
+    fields = {"name": "Name", "state": "State", "driver": "DriverName", "swarm": "Swarm"}
+    probe = float(env("PROBE_LATENCY", "0"))
+    lines = []
+    if not quiet and fmt is None:
+        lines.append("NAME\tACTIVE\tDRIVER\tSTATE\tURL\tSWARM\tDOCKER\tERRORS")
+    for name in names():
+        values = row(name)
+        if any(key in fields and values[fields[key]] != value for key, value in filters):
+            continue
+        if quiet:
+            lines.append(name)
+            continue
+        if probe:
+            time.sleep(probe)
+        if fmt is None:
+            fmt = "{{.Name}}\t{{.Active}}\t{{.DriverName}}\t{{.State}}\t{{.URL}}\t" \
+                "{{.Swarm}}\t{{.DockerVersion}}\t{{.Error}}"
+        lines.append(template(fmt, values))
+    print("\n".join(lines))
+
+
+def inspect(name):
+    path = os.path.join(storage(), "machines", name)
+    certs = os.path.join(storage(), "certs")
+    host = {
+        "ConfigVersion": 3,
+        "Driver": {
+            "IPAddress": ip(name),
+            "MachineName": name,
+            "SSHUser": "docker",
+            "SSHPort": 22,
+            "SSHKeyPath": os.path.join(path, "id_rsa"),
+            "StorePath": storage(),
+            "SwarmMaster": False,
+            "SwarmHost": "tcp://0.0.0.0:3376",
+            "SwarmDiscovery": "",
+            "CPU": 1,
+            "Memory": 1024,
+            "DiskSize": 20000,
+            "Boot2DockerURL": "",
+        },
+        "DriverName": env("DRIVER", "virtualbox"),
+        "HostOptions": {
+            "Driver": "",
+            "Memory": 0,
+            "Disk": 0,
+            "EngineOptions": {
+                "ArbitraryFlags": [],
+                "Env": [],
+                "InsecureRegistry": [],
+                "Labels": ["role=bench"],
+                "RegistryMirror": [],
+                "StorageDriver": "",
+                "TlsVerify": True,
+                "InstallURL": "https://get.docker.com",
+            },
+            "SwarmOptions": {
+                "IsSwarm": False,
+                "Address": "",
+                "Discovery": "",
+                "Master": False,
+                "Host": "tcp://0.0.0.0:3376",
+                "Image": "swarm:latest",
+                "Strategy": "spread",
+            },
+            "AuthOptions": {
+                "CertDir": certs,
+                "CaCertPath": os.path.join(certs, "ca.pem"),
+                "CaPrivateKeyPath": os.path.join(certs, "ca-key.pem"),
+                "ServerCertPath": os.path.join(path, "server.pem"),
+                "ServerKeyPath": os.path.join(path, "server-key.pem"),
+                "ClientKeyPath": os.path.join(certs, "key.pem"),
+                "ClientCertPath": os.path.join(certs, "cert.pem"),
+                "StorePath": path,
+            },
+        },
+        "Name": name,
+    }
+    print(json.dumps(host, indent=4))
+
+
+def config(name):
+    certs = os.path.join(storage(), "certs")
+    print("--tlsverify\n"
+          "--tlscacert=\"%s\"\n"
+          "--tlscert=\"%s\"\n"
+          "--tlskey=\"%s\"\n"
+          "-H=tcp://%s:2376" % (os.path.join(certs, "ca.pem"), os.path.join(certs, "cert.pem"),
+                                os.path.join(certs, "key.pem"), ip(name)))
+
+
+def env_command(name):
+    print('export DOCKER_TLS_VERIFY="1"\n'
+          'export DOCKER_HOST="tcp://%s:2376"\n'
+          'export DOCKER_CERT_PATH="%s"\n'
+          'export DOCKER_MACHINE_NAME="%s"\n'
+          '# Run this command to configure your shell: \n'
+          '# eval $(docker-machine env %s)' % (ip(name), os.path.join(storage(), "machines", name),
+                                                name, name))
+
+
+def create(args):
+    name = args[-1]
+    if name in names():
+        fail("Host already exists: \"%s\"" % name, 3)
+    driver = args[args.index("--driver") + 1] if "--driver" in args else "none"
+    for line in ("Running pre-create checks...",
+                 "Creating machine...",
+                 "(%s) Creating %s instance..." % (name, driver),
+                 "Waiting for machine to be running, this may take a few minutes...",
+                 "Detecting operating system of created instance...",
+                 "Waiting for SSH to be available...",
+                 "Detecting the provisioner...",
+                 "Provisioning with boot2docker...",
+                 "Copying certs to the local machine directory...",
+                 "Copying certs to the remote machine...",
+                 "Setting Docker configuration on the remote daemon...",
+                 "Checking connection to Docker...",
+                 "Docker is up and running!"):
+        print(line)
+        sys.stdout.flush()
+    if failing(name):
+        fail("Error creating machine: Error running provisioning: ssh command error")
+
+
+def action(verb, args):
+    targets = [x for x in args if not x.startswith("-")]
+    known = set(names())
+    errors = []
+    for name in targets:
+        if name not in known:
+            errors.append("Host does not exist: \"%s\"" % name)
+        elif failing(name):
+            errors.append("Error %s \"%s\": unexpected driver error" % (verb, name))
+        else:
+            for line in ACTIONS[verb]:
+                print(line % name)
+    if errors:
+        fail("\n".join(errors))
+
+
+def main(argv):
+    random.seed(env("SEED"))
+    latency = float(env("LATENCY", "0"))
+    if latency:
+        time.sleep(latency)
+    if not argv:
+        fail("Usage: docker-machine [OPTIONS] COMMAND [arg...]")
+    verb, args = argv[0], argv[1:]
+    if verb == "version":
+        print(VERSION)
+    elif verb == "ls":
+        ls(args)
+    elif verb == "create":
+        create(args)
+    elif verb in ACTIONS:
+        action(verb, args)
+    elif verb == "active":
+        fail("No active host found")
+    elif verb in ("inspect", "ip", "url", "status", "config", "env"):
+        name = args[-1] if args and not args[-1].startswith("-") else "default"
+        if name not in names():
+            fail("Host does not exist: \"%s\"" % name)
+        if failing(name):
+            fail("Error checking TLS connection: unexpected driver error")
+        if verb == "inspect":
+            inspect(name)
+        elif verb == "ip":
+            print(ip(name))
+        elif verb == "url":
+            print("tcp://%s:2376" % ip(name))
+        elif verb == "status":
+            print(env("STATE", "Running"))
+        elif verb == "config":
+            config(name)
+        else:
+            env_command(name)
+    else:
+        fail("docker-machine: '%s' is not a docker-machine command." % verb)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
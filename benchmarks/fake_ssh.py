@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the ssh client, running the remote commands locally with
+`sh -c`. The master connection (ControlMaster=yes) is a plain file at the
+ControlPath, `-O exit` removes it.
+
+Configured through environment variables:
+
+    FAKE_SSH_LATENCY    seconds a new connection (handshake) takes, default 0
+    FAKE_SSH_LOG        file getting a line per handshake
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+# ssh options taking a value
+VALUE_OPTIONS = set("bcDEeFIiJLlmOoPpRSWw")
+
+
+def parse(argv):
+    """
+    Returns:
+        tuple: the -o options as a dict, the -O control command, the flags and the remote command
+    """
+    options, control, flags = {}, None, set()
+    i = 0
+    while i < len(argv) and argv[i].startswith("-"):
+        flag = argv[i][1:]
+        if flag in VALUE_OPTIONS:
+            value = argv[i + 1]
+            i += 1
+            if flag == "o":
+                key, _, value = value.partition("=")
+                options[key] = value
+            elif flag == "O":
+                control = value
+        else:
+            flags.update(flag)
+        i += 1
+    # argv[i] is the destination
+    return options, control, flags, argv[i + 1:]
+
+
+def handshake():
+    latency = float(os.environ.get("FAKE_SSH_LATENCY", "0"))
+    if latency:
+        time.sleep(latency)
+    log = os.environ.get("FAKE_SSH_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write("handshake\n")
+
+
+def main(argv):
+    options, control, flags, command = parse(argv)
+    path = options.get("ControlPath")
+    if control == "exit":
+        if path and os.path.exists(path):
+            os.remove(path)
+            return 0
+        return 255
+    if options.get("ControlMaster") == "yes":
+        handshake()
+        with open(path, "w"):
+            pass
+        return 0
+    if not (path and os.path.exists(path)):
+        handshake()
+    if "N" in flags:
+        return 0
+    return subprocess.call(["sh", "-c", " ".join(command)])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
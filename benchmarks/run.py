@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the machine package, run against benchmarks/fake_machine.py
+so no docker-machine, driver or docker daemon is needed.
+
+    python -m benchmarks.run --output results.json
+
+Results are written as JSON, compare the files of two releases to spot
+regressions. Timings are in milliseconds.
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import machine
+from machine.machine import LS_FIELDS, LS_SEPARATOR
+from machine.helper import format_as_table, write_table
+from machine.records import parse_ls_row
+
+FAKE_MACHINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_machine.py")
+FAKE_SSH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ssh.py")
+
+SIZES = [10, 1000, 10000]
+CONCURRENCY = [1, 2, 4, 8, 16, 32, 64]
+
+
+def fake_binary(directory):
+    """
+    Write a `docker-machine` executable running fake_machine.py with the
+    current interpreter.
+
+    Returns:
+        str: path of the executable
+    """
+    path = os.path.join(directory, "docker-machine")
+    with open(path, "w") as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, FAKE_MACHINE))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def fake_storage(directory):
+    """
+    Create the storage directory fake_machine.py points at, with
+    placeholder certificates: docker-py checks they exist when building a
+    client.
+
+    Returns:
+        str: path of the storage directory
+    """
+    storage = os.path.join(directory, "storage")
+    certs = os.path.join(storage, "certs")
+    os.makedirs(certs)
+    for name in ("ca.pem", "cert.pem", "key.pem"):
+        with open(os.path.join(certs, name), "w") as f:
+            f.write("placeholder\n")
+    return storage
+
+
+def configure(count=10, latency=0, probe_latency=0, fail="", fail_rate=0):
+    """
+    Set the FAKE_MACHINE_* variables read by fake_machine.py.
+    """
+    os.environ.update({
+        "FAKE_MACHINE_COUNT": str(count),
+        "FAKE_MACHINE_LATENCY": str(latency),
+        "FAKE_MACHINE_PROBE_LATENCY": str(probe_latency),
+        "FAKE_MACHINE_FAIL": fail,
+        "FAKE_MACHINE_FAIL_RATE": str(fail_rate),
+    })
+
+
+def measure(func, repeat):
+    """
+    Call func repeat times.
+
+    Returns:
+        dict: see summarize
+    """
+    durations = []
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        durations.append(time.time() - started)
+    return summarize(durations)
+
+
+def summarize(durations):
+    """
+    Args:
+        durations (List[float]): durations in seconds
+    Returns:
+        dict: mean, min, max, p50 and p95 durations in milliseconds
+    """
+    durations = sorted(x * 1000 for x in durations)
+    return {
+        "repeat": len(durations),
+        "mean": sum(durations) / len(durations),
+        "min": durations[0],
+        "max": durations[-1],
+        "p50": durations[len(durations) // 2],
+        "p95": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+    }
+
+
+IMPORT_SCRIPT = """
+import time
+started = time.time()
+import machine
+imported = time.time()
+machine.Machine(path=%r)
+print("%%f %%f" %% (imported - started, time.time() - imported))
+"""
+
+
+def bench_import(path, repeat):
+    """
+    Cost of `import machine` and of the first Machine, each in a fresh interpreter.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    imports, first = [], []
+    for _ in range(repeat):
+        stdout = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT % path], cwd=root)
+        values = stdout.decode("utf-8").split()
+        imports.append(float(values[0]))
+        first.append(float(values[1]))
+    return [{"name": "import", "params": {}, "stats": summarize(imports)},
+            {"name": "first_machine", "params": {}, "stats": summarize(first)}]
+
+
+def bench_methods(path, repeat):
+    """
+    Per call cost of every Machine method: spawning docker-machine, the
+    existence check and parsing, with and without the caches.
+    """
+    configure(count=10)
+    name = "machine-00000"
+    methods = [
+        ("version", lambda m: m.version()),
+        ("ls", lambda m: m.ls(pprint=False)),
+        ("iter_ls", lambda m: list(m.iter_ls())),
+        ("exists", lambda m: m.exists(name)),
+        ("status", lambda m: m.status(name)),
+        ("status_many", lambda m: m.status_many([name])),
+        ("ip", lambda m: m.ip(name)),
+        ("url", lambda m: m.url(name)),
+        ("inspect", lambda m: m.inspect(name)),
+        ("config", lambda m: m.config(name)),
+        ("env", lambda m: m.env(name)),
+        ("start", lambda m: m.start(name)),
+        ("stop", lambda m: m.stop(name)),
+        ("restart", lambda m: m.restart(name)),
+        ("create", lambda m: m.create("bench-new", "none", {"url": "tcp://10.0.0.1:2376"})),
+    ]
+    setups = [
+        ("uncached", dict(index_ttl=0, cache_size=0, status_ttl=0)),
+        ("default", {}),
+    ]
+    results = []
+    for setup, kwargs in setups:
+        m = machine.Machine(path=path, **kwargs)
+        for method, call in methods:
+            call(m)  # warm up
+            results.append({
+                "name": "method",
+                "params": {"method": method, "setup": setup},
+                "stats": measure(lambda: call(m), repeat),
+            })
+    return results
+
+
+def bench_parsing(path, sizes, repeat):
+    """
+    Cost of parsing `ls` and formatting tables, without any process spawned.
+    """
+    results = []
+    m = machine.Machine(path=path)
+    for size in sizes:
+        configure(count=size)
+        cmd = [path] + m._ls_cmd(timeout=10)
+        stdout = subprocess.check_output(cmd).decode("utf-8")
+        rows = m._parse_ls(stdout)
+
+        def records():
+            return [parse_ls_row(line.split(LS_SEPARATOR)) for line in stdout.splitlines()]
+
+        def table():
+            return format_as_table(rows, keys=LS_FIELDS, header=LS_FIELDS)
+
+        def streamed():
+            write_table(rows, keys=LS_FIELDS, header=LS_FIELDS, stream=io.StringIO())
+
+        for name, func in [("parse_ls", lambda: m._parse_ls(stdout)),
+                           ("parse_ls_records", records),
+                           ("format_as_table", table),
+                           ("write_table", streamed)]:
+            results.append({
+                "name": name,
+                "params": {"machines": size},
+                "stats": measure(func, repeat),
+            })
+    return results
+
+
+def bench_fanout(path, machines, latency, concurrency):
+    """
+    Wall time of a call on many machines as the concurrency grows, and of
+    the single command *_many variants.
+    """
+    configure(count=machines, latency=latency)
+    m = machine.Machine(path=path, cache_size=0)
+    names = ["machine-%05d" % i for i in range(machines)]
+    results = []
+    baseline = None
+    for level in concurrency:
+        started = time.time()
+        _, errors = m.bulk("ip", names, concurrency=level)
+        elapsed = time.time() - started
+        baseline = baseline or elapsed
+        results.append({
+            "name": "fanout",
+            "params": {"method": "ip", "machines": machines, "concurrency": level,
+                       "latency": latency},
+            "stats": {
+                "wall": elapsed * 1000,
+                "calls_per_second": machines / elapsed,
+                "speedup": baseline / elapsed,
+                "errors": len(errors),
+            },
+        })
+    for method, call in [("stop_many", lambda: m.stop_many(names)),
+                         ("bulk_stop", lambda: m.bulk("stop", names, concurrency=8))]:
+        started = time.time()
+        _, errors = call()
+        elapsed = time.time() - started
+        results.append({
+            "name": "fanout",
+            "params": {"method": method, "machines": machines, "latency": latency},
+            "stats": {"wall": elapsed * 1000, "errors": len(errors)},
+        })
+    return results
+
+
+def bench_ssh(path, commands, latency):
+    """
+    Wall time of many small commands on a machine, over the multiplexed
+    connection and with a new connection per command.
+    """
+    configure(count=1)
+    os.environ["FAKE_SSH_LATENCY"] = str(latency)
+    m = machine.Machine(path=path, ssh_path=FAKE_SSH)
+    name = "machine-00000"
+    results = []
+    for setup, close in [("multiplexed", False), ("handshake_per_command", True)]:
+        started = time.time()
+        for _ in range(commands):
+            m.ssh(name, "true")
+            if close:
+                m.close_ssh(name)
+        elapsed = time.time() - started
+        m.close_ssh()
+        results.append({
+            "name": "ssh",
+            "params": {"setup": setup, "commands": commands, "latency": latency},
+            "stats": {"wall": elapsed * 1000},
+        })
+    return results
+
+
+def bench_transfer(path, size, repeat):
+    """
+    Throughput of put and get of a `size` MiB file over the ssh connection.
+    """
+    configure(count=1)
+    os.environ["FAKE_SSH_LATENCY"] = "0"
+    m = machine.Machine(path=path, ssh_path=FAKE_SSH)
+    name = "machine-00000"
+    directory = tempfile.mkdtemp(prefix="machine-bench-transfer-")
+    remote = os.path.join(directory, "remote")
+    data = os.urandom(size * 1024 * 1024)
+
+    def get():
+        with m.get(name, remote) as stream:
+            for _ in iter(lambda: stream.read(64 * 1024), b""):
+                pass
+
+    try:
+        results = []
+        for method, call in [("put", lambda: m.put(name, memoryview(data), remote)),
+                             ("get", get)]:
+            stats = measure(call, repeat)
+            stats["mib_per_second"] = size / (stats["mean"] / 1000)
+            results.append({"name": "transfer", "params": {"method": method, "mib": size},
+                            "stats": stats})
+        return results
+    finally:
+        m.close_ssh()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_run_on(path, machines, latency, concurrency):
+    """
+    Wall time of a command run on every machine with run_on as the
+    concurrency grows, each command taking `latency` seconds.
+    """
+    configure(count=machines)
+    os.environ["FAKE_SSH_LATENCY"] = "0"
+    m = machine.Machine(path=path, ssh_path=FAKE_SSH)
+    names = ["machine-%05d" % i for i in range(machines)]
+    cmd = "sleep %s; echo ok" % latency
+    # connect first, only the commands are measured
+    m.run_on(names, "true", concurrency=max(concurrency)).wait()
+    results = []
+    for level in concurrency:
+        started = time.time()
+        returncodes, errors = m.run_on(names, cmd, concurrency=level).wait()
+        elapsed = time.time() - started
+        results.append({
+            "name": "run_on",
+            "params": {"machines": machines, "concurrency": level, "latency": latency},
+            "stats": {"wall": elapsed * 1000, "errors": len(errors),
+                      "failed": sum(1 for x in returncodes.values() if x)},
+        })
+    m.close_ssh()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the machine package")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--sizes", default=",".join(str(x) for x in SIZES),
+                        help="comma separated fleet sizes of the parsing benchmarks")
+    parser.add_argument("--repeat", type=int, default=20, help="calls per method measured")
+    parser.add_argument("--fanout-machines", type=int, default=64)
+    parser.add_argument("--fanout-latency", type=float, default=0.05,
+                        help="seconds every fake command sleeps in the fan-out benchmark")
+    parser.add_argument("--ssh-commands", type=int, default=50)
+    parser.add_argument("--ssh-latency", type=float, default=0.1,
+                        help="seconds every fake ssh handshake takes")
+    parser.add_argument("--transfer-size", type=int, default=64,
+                        help="MiB sent and received by the transfer benchmark")
+    parser.add_argument("--only", action="append",
+                        choices=["import", "methods", "parsing", "fanout", "ssh"],
+                        help="run only these benchmarks")
+    args = parser.parse_args(argv)
+    only = args.only or ["import", "methods", "parsing", "fanout", "ssh"]
+    sizes = [int(x) for x in args.sizes.split(",")]
+
+    directory = tempfile.mkdtemp(prefix="machine-bench-")
+    environ = dict(os.environ)
+    try:
+        path = fake_binary(directory)
+        os.environ["FAKE_MACHINE_STORAGE"] = fake_storage(directory)
+        results = []
+        if "import" in only:
+            results += bench_import(path, max(1, args.repeat // 4))
+        if "methods" in only:
+            results += bench_methods(path, args.repeat)
+        if "parsing" in only:
+            results += bench_parsing(path, sizes, max(1, args.repeat // 4))
+        if "fanout" in only:
+            results += bench_fanout(path, args.fanout_machines, args.fanout_latency,
+                                    [x for x in CONCURRENCY if x <= args.fanout_machines])
+        if "ssh" in only:
+            results += bench_ssh(path, args.ssh_commands, args.ssh_latency)
+            results += bench_run_on(path, args.fanout_machines, args.fanout_latency,
+                                    [x for x in CONCURRENCY if x <= args.fanout_machines])
+            results += bench_transfer(path, args.transfer_size, max(1, args.repeat // 4))
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "version": machine.__version__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for result in results:
+        stats = result["stats"]
+        value = stats.get("mean", stats.get("wall"))
+        print("%-18s %-60s %10.3f ms" % (result["name"], json.dumps(result["params"], sort_keys=True),
+                                         value))
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,50 @@
 from __future__ import absolute_import
-import pkg_resources
 import logging
+import sys
 
 from .machine import Machine
+from .store import FileStore
+from .records import MachineRecord, State
+from .hooks import Hooks, LoggingHooks, CommandTrace
 from machine import configs
 
-try:
-    __version__ = pkg_resources.require("python-docker-machine")[0].version
-except pkg_resources.DistributionNotFound:
-    __version__ = "devel"
-
 # ### ---- logger
-# 1. logger
+# its handler is attached by the first Machine, see helper.setup_logger
 logger = logging.getLogger("machine")
-logger.setLevel(logging.INFO)
-
-# 2. Add handler
-steam_handler = logging.StreamHandler()
-steam_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
-steam_handler.setFormatter(formatter)
-logger.addHandler(steam_handler)
+
+
+def _version():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        # python < 3.8
+        import pkg_resources
+        try:
+            return pkg_resources.require("python-docker-machine")[0].version
+        except pkg_resources.DistributionNotFound:
+            return "devel"
+    try:
+        return version("python-docker-machine")
+    except PackageNotFoundError:
+        return "devel"
+
+
+def __getattr__(name):
+    """
+    Resolve the attributes that are slow to import on first access (PEP 562).
+    """
+    if name == "__version__":
+        value = _version()
+    elif name == "AsyncMachine" and sys.version_info >= (3, 5):
+        from .aio import AsyncMachine as value
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):
+    # no module __getattr__, resolve them now
+    __version__ = _version()
+    if sys.version_info >= (3, 5):
+        from .aio import AsyncMachine
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio version of the Machine API, every command is awaitable and runs
+through an asyncio subprocess so the event loop is never blocked.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from asyncio.subprocess import PIPE, DEVNULL
+
+from .machine import BaseMachine, VERSION_REGEXP, CONFIG_REGEXP, READ_COMMANDS
+from .cache import MISSING
+from .hooks import CommandTrace
+from .records import parse_env
+from . import environ
+from .process import STDOUT, STDERR
+from .errors import MachineNotFoundError, MachineAlreadyExistsError, CommandTimeoutError
+
+
+logger = logging.getLogger("machine")
+
+
+class _AsyncFlight(object):
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight(object):
+    """
+    asyncio version of SingleFlight: concurrent callers asking for the same
+    key await a single task. The task is cancelled once every caller is
+    cancelled, so an abandoned command doesn't keep running.
+    """
+    def __init__(self):
+        self._flights = {}
+
+    async def do(self, key, func, timeout=None):
+        """
+        Args:
+            key (hashable): identifies identical calls
+            func (callable): returns the coroutine to run, called by the first caller
+            timeout (float): seconds the other callers wait for the first one
+        Returns:
+            the result of the coroutine
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[key] = _AsyncFlight(asyncio.ensure_future(func()))
+
+            def done(_):
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+            flight.task.add_done_callback(done)
+        flight.waiters += 1
+        try:
+            if leader:
+                return await asyncio.shield(flight.task)
+            return await asyncio.wait_for(asyncio.shield(flight.task), timeout)
+        except asyncio.TimeoutError:
+            raise CommandTimeoutError("timed out after %.1fs waiting for %s" % (timeout, key))
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+
+
+class AsyncMachine(BaseMachine):
+    """
+    asyncio counterpart of Machine, every command method is a coroutine.
+    It shares the caches, metrics, hooks and parsing of Machine through
+    BaseMachine, the batch (*_many, map, bulk), monitoring and ssh methods
+    of Machine have no asyncio version.
+
+    Each call accepts a `timeout` in seconds (defaults to the one given to
+    the constructor, then to the per command `timeouts`), the docker-machine
+    process group is killed when the timeout expires or when the calling
+    task is cancelled.
+    """
+    def __init__(self, path="docker-machine", index_ttl=10, store=None, timeouts=None,
+                 timeout=None, singleflight=True, cache_size=256, cache_ttl=60, hooks=None):
+        """
+        Args:
+            path (str): path to docker-machine binary
+            index_ttl (float): seconds the machine name index stays valid
+            store (FileStore): answer read calls from the storage directory
+            timeouts (dict): default timeout per command, merged over DEFAULT_TIMEOUTS
+            timeout (float): timeout of every command, overrides timeouts
+            singleflight (bool): concurrent identical READ_COMMANDS share a
+                single docker-machine process and its output
+            cache_size (int): results of env kept, 0 to disable caching
+            cache_ttl (float): seconds a cached result stays valid
+            hooks (List[Hooks]): called around every docker-machine invocation
+        """
+        super(AsyncMachine, self).__init__(path=path, index_ttl=index_ttl, store=store,
+                                           timeouts=timeouts, cache_size=cache_size,
+                                           cache_ttl=cache_ttl, hooks=hooks)
+        self.timeout = timeout
+        self._flights = AsyncSingleFlight() if singleflight else None
+
+    def __contains__(self, machine):
+        raise TypeError("use `await AsyncMachine.exists(machine)`")
+
+    async def _run(self, cmd, raise_error=True, verbose=False, timeout=None):
+        """
+        Run a docker-machine command, optionally raise error if error code != 0
+
+        Args:
+            cmd (List[str]): a list of the docker-machine command with the arguments to run
+            raise_error (bool): raise an exception on non 0 return code
+            verbose (bool): log stdout lines as they come
+            timeout (float): seconds before the process is killed
+        Returns:
+            tuple: stdout, stderr, error_code
+        """
+        timeout = self._timeout(cmd, self.timeout if timeout is None else timeout)
+        if not verbose and self._flights is not None and cmd and cmd[0] in READ_COMMANDS:
+            stdout, stderr, error_code = await self._flights.do(
+                tuple(cmd), lambda: self._run_process(cmd, False, timeout), timeout)
+        else:
+            stdout, stderr, error_code = await self._run_process(cmd, verbose, timeout)
+        if raise_error and error_code:
+            raise RuntimeError("cmd returned error %s: %s" % (error_code, stderr.strip()))
+        return stdout, stderr, error_code
+
+    async def _run_process(self, cmd, verbose=False, timeout=None):
+        verb = cmd[0] if cmd else ""
+        started = self.metrics.started(verb)
+        trace = CommandTrace([self.path] + cmd, started) if self.hooks else None
+        try:
+            stdout, stderr, p = await self._spawn(cmd, verbose, timeout, trace)
+        except CommandTimeoutError as e:
+            self.metrics.finished(verb, started, expired=True)
+            if trace is not None:
+                self._trace_exit(trace, None, True, e)
+            raise
+        except BaseException as e:
+            self.metrics.finished(verb, started)
+            if trace is not None:
+                self._trace_exit(trace, None, False, e)
+            raise
+        self.metrics.finished(verb, started, p.returncode, len(stdout), len(stderr))
+        if trace is not None:
+            self._trace_exit(trace, p.returncode, False)
+        return stdout.decode('utf-8'), stderr.decode('utf-8'), p.returncode
+
+    async def _spawn(self, cmd, verbose=False, timeout=None, trace=None):
+        p = await asyncio.create_subprocess_exec(self.path, *cmd, stdin=DEVNULL,
+                                                 stdout=PIPE, stderr=PIPE,
+                                                 start_new_session=os.name == "posix")
+        if trace is not None:
+            trace.pid, trace.spawned = p.pid, time.time()
+            self._emit("on_start", trace)
+        try:
+            if trace is not None:
+                communicate = self._communicate_lines(p, verbose, trace)
+            elif verbose:
+                communicate = self._communicate_verbose(p)
+            else:
+                communicate = p.communicate()
+            stdout, stderr = await asyncio.wait_for(communicate, timeout)
+        except asyncio.TimeoutError:
+            await self._kill(p)
+            raise CommandTimeoutError("cmd %s timed out after %.1fs" % (" ".join(cmd), timeout))
+        except BaseException:
+            # cancelled: don't leave the child behind
+            await self._kill(p)
+            raise
+        return stdout, stderr, p
+
+    async def _communicate_verbose(self, p):
+        async def read_stdout():
+            lines = []
+            async for line in p.stdout:
+                lines.append(line)
+                logger.info(line.decode('utf-8').replace("\n", " "))
+            return b"".join(lines)
+
+        stdout, stderr = await asyncio.gather(read_stdout(), p.stderr.read())
+        await p.wait()
+        return stdout, stderr
+
+    async def _communicate_lines(self, p, verbose, trace):
+        """
+        Read stdout and stderr line by line for the on_line hooks.
+        """
+        async def read(stream, pipe):
+            lines = []
+            async for line in pipe:
+                timestamp = time.time()
+                if trace.first_byte is None:
+                    trace.first_byte = timestamp
+                lines.append(line)
+                line = line.decode('utf-8', 'replace').rstrip("\r\n")
+                if verbose and stream == STDOUT:
+                    logger.info(line)
+                self._emit("on_line", trace, stream, line, timestamp)
+            return b"".join(lines)
+
+        stdout, stderr = await asyncio.gather(read(STDOUT, p.stdout), read(STDERR, p.stderr))
+        await p.wait()
+        return stdout, stderr
+
+    async def _kill(self, p):
+        if p.returncode is None:
+            try:
+                if os.name == "posix":
+                    os.killpg(p.pid, signal.SIGKILL)
+                else:
+                    p.kill()
+            except ProcessLookupError:
+                pass
+            await p.wait()
+
+    async def _match(self, cmd, regexp, timeout=None):
+        stdout, stderr, errorcode = await self._run(cmd, timeout=timeout)
+        return self._parse_match(stdout, regexp)
+
+    async def _names(self, timeout=None):
+        if self.store is not None:
+            return self.store.names()
+        stamp = self._storage_stamp()
+        if self._index is not None and stamp == self._index_stamp \
+                and time.time() < self._index_expires:
+            return self._index
+        stdout, _, _ = await self._run(["ls", "-q"], timeout=timeout)
+        with self._index_lock:
+            self._set_index(stdout.split(), stamp)
+            return self._index
+
+    async def _action(self, cmd, machine, timeout=None):
+        """
+        Check machine exists then run cmd, the pattern of most commands.
+        """
+        try:
+            if await self.check_if_exists(machine, timeout=timeout):
+                await self._run(cmd, timeout=timeout)
+                return True
+        finally:
+            self.invalidate_cache(machine)
+
+    async def version(self, timeout=None):
+        match = await self._match(["version"], VERSION_REGEXP, timeout=timeout)
+        return match.group(1)
+
+    async def config(self, machine="default", timeout=None):
+        config = self.store.config(machine) if self.store is not None else None
+        if not config:
+            match = await self._match(["config", machine], CONFIG_REGEXP, timeout=timeout)
+            config = self._parse_config(match)
+        return self._config_params(config)
+
+    async def client(self, machine="default", timeout=None, **kwargs):
+        """
+        Shared docker client of the machine, see Machine.client. The client
+        itself is synchronous.
+        """
+        client = self._cached_client(machine)
+        if client is None:
+            params = await self.config(machine, timeout=timeout)
+            client = self._new_client(machine, params, **kwargs)
+        return client
+
+    async def ls(self, timeout=10, pprint=True, filters=None):
+        """
+        List machines, `timeout` is the daemon probe timeout of docker-machine
+        and the process itself is bounded by the instance timeout. See
+        Machine.ls for filters.
+        """
+        stdout, stderr, errorcode = await self._run(self._ls_cmd(timeout, filters))
+        machines = self._parse_ls(stdout, filters)
+        if pprint:
+            self._print_ls(machines)
+        return machines
+
+    async def exists(self, machine="default", timeout=None):
+        return machine in await self._names(timeout=timeout)
+
+    async def check_if_exists(self, machine="default", timeout=None):
+        if await self.exists(machine, timeout=timeout):
+            return True
+        raise MachineNotFoundError("No machine named %s found" % machine)
+
+    async def status(self, machine="default", timeout=None):
+        if await self.check_if_exists(machine, timeout=timeout):
+            stdout, _, _ = await self._run(["status", machine], timeout=timeout)
+            return stdout.strip() == "Running"
+
+    async def stop(self, machine="default", timeout=None):
+        return await self._action(["stop", machine], machine, timeout=timeout)
+
+    async def start(self, machine="default", timeout=None):
+        return await self._action(["start", machine], machine, timeout=timeout)
+
+    async def provision(self, machine="default", timeout=None):
+        return await self._action(["provision", machine], machine, timeout=timeout)
+
+    async def regenerate_certs(self, machine="default", timeout=None):
+        try:
+            return await self._action(["regenerate-certs", "--force", machine], machine,
+                                      timeout=timeout)
+        finally:
+            self.invalidate_client(machine)
+
+    async def kill(self, machine="default", timeout=None):
+        return await self._action(["kill", machine], machine, timeout=timeout)
+
+    async def restart(self, machine="default", timeout=None):
+        return await self._action(["restart", machine], machine, timeout=timeout)
+
+    async def upgrade(self, machine="default", timeout=None):
+        return await self._action(["upgrade", machine], machine, timeout=timeout)
+
+    async def rm(self, machine="default", force=False, timeout=None):
+        f = ["-f"] if force else []
+        try:
+            return await self._action(["rm", "-y"] + f + [machine], machine, timeout=timeout)
+        finally:
+            self.invalidate_index()
+            self.invalidate_client(machine)
+
+    async def env(self, machine="default", swarm=False, timeout=None):
+        """
+        Environment variables targeting the machine, cached as in Machine.env.
+        """
+        key = ("env", machine, bool(swarm))
+        variables = self._results.get(key) if self._results is not None else MISSING
+        if variables is MISSING:
+            await self.check_if_exists(machine, timeout=timeout)
+            cmd = ["env", machine]
+            if swarm:
+                cmd.append("--swarm")
+            stdout, _, _ = await self._run(cmd, timeout=timeout)
+            with self.metrics.parsing("env"):
+                variables = parse_env(stdout)
+            if self._results is not None:
+                self._results.put(key, variables)
+        return dict(variables)
+
+    async def subprocess_env(self, machine="default", swarm=False, base=None, timeout=None):
+        environment = dict(base) if base is not None else environ.current()
+        environment.update(await self.env(machine, swarm=swarm, timeout=timeout))
+        return environment
+
+    async def scoped_env(self, machine="default", swarm=False, timeout=None):
+        """
+        Use as `with await m.scoped_env(machine) as env:`, see Machine.scoped_env.
+        The scope follows the task (and the tasks it creates) on python 3.7+.
+        Before that it belongs to the thread, so don't await inside the block.
+        """
+        return environ.scoped(await self.env(machine, swarm=swarm, timeout=timeout))
+
+    async def eval_env(self, machine="default", swarm=False, timeout=None):
+        os.environ.update(await self.env(machine=machine, swarm=swarm, timeout=timeout))
+        return True
+
+    async def inspect(self, machine="default", timeout=None):
+        if await self.check_if_exists(machine, timeout=timeout):
+            if self.store is not None:
+                host = self.store.inspect(machine)
+                if host is not None:
+                    return host
+            stdout, _, _ = await self._run(["inspect", machine], timeout=timeout)
+            with self.metrics.parsing("inspect"):
+                return json.loads(stdout)
+
+    async def ip(self, machine="default", timeout=None):
+        if await self.check_if_exists(machine, timeout=timeout):
+            ip = self.store.ip(machine) if self.store is not None else None
+            if ip:
+                return ip
+            stdout, _, _ = await self._run(["ip", machine], timeout=timeout)
+            return stdout.strip()
+
+    async def url(self, machine="default", timeout=None):
+        if await self.check_if_exists(machine, timeout=timeout):
+            url = self.store.url(machine) if self.store is not None else None
+            if url:
+                return url
+            stdout, _, _ = await self._run(["url", machine], timeout=timeout)
+            return stdout.strip()
+
+    async def active(self, timeout=None):
+        stdout, stderr, error_code = await self._run(["active"], raise_error=False, timeout=timeout)
+        if error_code == 1 and stderr.strip() == "No active host found":
+            return None
+        return stdout.strip()
+
+    async def scp(self, source, destination, recursive=False, timeout=None):
+        r = ["-r"] if recursive else []
+        stdout, _, _ = await self._run(["scp"] + r + [source, destination], timeout=timeout)
+        return stdout.split()
+
+    async def create(self, name, driver_name, driver_config={}, engine_opts=[],
+                     engine_labels=[], swarm=False, swarm_options={}, verbose=False,
+                     timeout=None):
+        """
+        Create a machine, see Machine.create. On error, timeout or
+        cancellation the half created machine is removed.
+        """
+        if await self.exists(name, timeout=timeout):
+            raise MachineAlreadyExistsError("Machine %s already exists" % name)
+        cmd = self._create_args(driver_name, driver_config, engine_opts,
+                                engine_labels, swarm, swarm_options) + [name]
+        self.invalidate_cache(name)
+        try:
+            await self._run(cmd, verbose=verbose, timeout=timeout)
+        except BaseException:
+            self.invalidate_index()
+            # shield the cleanup so a cancelled create still removes the host
+            await asyncio.shield(self._run(["rm", "-y", "-f", name], raise_error=False))
+            raise
+        self.invalidate_index()
+        return True
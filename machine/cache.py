@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache whose entries also expire `ttl`
+    seconds after they were stored.
+
+    Keys are tuples whose second item is the machine name, so every entry
+    of a machine can be evicted at once with evict(machine).
+    """
+    def __init__(self, maxsize=256, ttl=60):
+        """
+        Args:
+            maxsize (int): entries kept before the least recently used is dropped
+            ttl (float): seconds an entry stays valid, None to never expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """
+        Returns:
+            the value stored for key, default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or time.time() < entry[0]):
+                # most recently used last
+                del self._entries[key]
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def evict(self, machine):
+        """
+        Drop every entry of machine.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if len(key) > 1 and key[1] == machine]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        """
+        Returns:
+            CacheInfo: hits, misses, maxsize and currsize, like functools.lru_cache
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import threading
+
+from .errors import CommandTimeoutError
+
+
+class _Batch(object):
+    def __init__(self):
+        self.machines = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = {}
+        self.errors = {}
+        self.error = None
+
+
+class Coalescer(object):
+    """
+    Merge calls of the same command on different machines, made within
+    `window` seconds, into a single docker-machine invocation.
+
+    The first caller of a batch waits for the window to close then runs the
+    command for every machine collected, the other callers wait for its
+    result. Each caller gets the outcome of its own machine.
+    """
+    def __init__(self, run_many, window=0.05, max_batch=100):
+        """
+        Args:
+            run_many (callable): run_many(cmd, machines, deadline) returning
+                (results, errors) dicts keyed by machine, see Machine._run_many
+            window (float): seconds a batch stays open
+            max_batch (int): machines in a batch before it runs right away
+        """
+        self.run_many = run_many
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def run(self, cmd, machine, deadline=None):
+        """
+        Run cmd on machine as part of a batch.
+
+        Args:
+            cmd (List[str]): the docker-machine command without machine names
+            machine (str): the name of the machine
+            deadline (float): absolute time.time() the batch must finish by,
+                only the deadline of the first caller is used
+        Returns:
+            bool: True if successful
+        """
+        key = tuple(cmd)
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = _Batch()
+            batch.machines.append(machine)
+            if len(batch.machines) >= self.max_batch:
+                del self._pending[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            try:
+                batch.results, batch.errors = self.run_many(cmd, batch.machines, deadline)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        if machine in batch.errors:
+            raise batch.errors[machine]
+        return True
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Share a single call among the concurrent callers asking for the same key.
+
+    The first caller runs the function, the callers arriving while it runs
+    wait for it and get the same result or exception. Nothing is kept once
+    the call returns, the next caller runs the function again.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        """
+        Args:
+            key (hashable): identifies identical calls
+            func (callable): called without arguments by the first caller
+            timeout (float): seconds the other callers wait for the first one
+        Returns:
+            the result of func
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if leader:
+            try:
+                flight.result = func()
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+            return flight.result
+        if not flight.done.wait(timeout):
+            raise CommandTimeoutError("timed out after %.1fs waiting for %s" % (timeout, key))
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
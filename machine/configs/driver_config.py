@@ -2,7 +2,7 @@
 # @Author: ThomasO
 # FROM: https://github.com/jgrowl/docker-machine-py/tree/master/docker_machine
 import os
-import errors
+from . import errors
 
 
 class DriverConfig(object):
@@ -28,7 +28,7 @@ class DriverConfig(object):
         Mostly translating snake_case to spinal-case and adding prefix
         """
         arg_dictionary = {}
-        for k, v in vars(self).iteritems():
+        for k, v in vars(self).items():
             key = self._format_key(k) \
                 if k in self.non_driver_keys() else self._format_driver_key(k)
             value = self._format_val(v)
@@ -36,7 +36,7 @@ class DriverConfig(object):
                 arg_dictionary[key] = value
 
         # no_none_values = {k: v for k, v in arg_dictionary.items() if v is not None}
-        return ["{}={}".format(k, v) for k, v in arg_dictionary.iteritems()]
+        return ["{}={}".format(k, v) for k, v in arg_dictionary.items()]
 
     def _format_key(self, arg):
         """ format to spinal-case and add '--' """
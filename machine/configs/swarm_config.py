@@ -25,7 +25,7 @@ class SwarmConfig(object):
         Mostly translating snake_case to spinal-case and adding prefix
         """
         args_list = []
-        for k, v in vars(self).iteritems():
+        for k, v in vars(self).items():
             if k == "swarm_master" and v is True:
                 args_list.append(self._format_key(k))
             else:
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Environments scoped to a thread, or to an asyncio task on python 3.7+, to
+target a machine without modifying the process wide os.environ.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import contextvars
+except ImportError:
+    # python < 3.7: the scopes belong to the thread
+    contextvars = None
+
+if contextvars is not None:
+    # each thread starts with an empty context, each task with a copy of
+    # the context that created it
+    _stack = contextvars.ContextVar("machine_environ", default=())
+
+    def _get():
+        return _stack.get()
+
+    def _push(environment):
+        return _stack.set(_stack.get() + (environment,))
+
+    def _pop(token):
+        _stack.reset(token)
+else:
+    _local = threading.local()
+
+    def _get():
+        return getattr(_local, "stack", ())
+
+    def _push(environment):
+        _local.stack = _get() + (environment,)
+
+    def _pop(token):
+        _local.stack = _local.stack[:-1]
+
+
+def current():
+    """
+    Returns:
+        dict: the environment of the current thread or task, os.environ
+            overlaid with the variables of the enclosing `scoped` blocks
+    """
+    stack = _get()
+    return dict(stack[-1]) if stack else dict(os.environ)
+
+
+@contextmanager
+def scoped(variables):
+    """
+    Overlay variables on the environment of the current thread (or asyncio
+    task) for the block. Yields the resulting environment, ready to be
+    given to subprocess.
+
+    Args:
+        variables (dict): value by variable name
+    """
+    environment = current()
+    environment.update(variables)
+    token = _push(environment)
+    try:
+        yield dict(environment)
+    finally:
+        _pop(token)
@@ -8,3 +8,19 @@ class MachineNotFoundError(Exception):
 
 class MachineAlreadyExistsError(Exception):
     pass
+
+
+class CommandTimeoutError(RuntimeError):
+    pass
+
+
+class RollbackError(RuntimeError):
+    """
+    A machine failed to be created and removing it failed too, it may be
+    left half created. `error` is the creation error, `rollback_error` the
+    removal one.
+    """
+    def __init__(self, message, error=None, rollback_error=None):
+        super(RollbackError, self).__init__(message)
+        self.error = error
+        self.rollback_error = rollback_error
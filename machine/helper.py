@@ -1,5 +1,31 @@
+import json
+import logging
 import os
-from operator import itemgetter
+import sys
+import threading
+import time
+from io import StringIO
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from enum import Enum
+except ImportError:
+    Enum = None
+
+from .errors import CommandTimeoutError
+
+# default storage path of docker-machine, overridden by MACHINE_STORAGE_PATH
+DEFAULT_STORAGE_PATH = os.path.join("~", ".docker", "machine")
+
+# programs found by resolve, keyed by (program, PATH)
+_resolved = {}
+
+_logger_lock = threading.Lock()
+_logger_ready = False
 
 
 def which(program):
@@ -29,6 +55,292 @@ def which(program):
     return None
 
 
+def resolve(program):
+    """
+    Same as which, memoized: the system path is walked once per program and
+    PATH value, as long as the program found stays executable.
+
+    Args:
+        program (str): the program to be found
+    Returns:
+        if found the full path to the program, else None
+    """
+    key = (program, "" if os.path.dirname(program) else os.environ.get("PATH", ""))
+    where = _resolved.get(key)
+    if where is not None and os.path.isfile(where) and os.access(where, os.X_OK):
+        return where
+    where = which(program)
+    if where:
+        _resolved[key] = where
+    return where
+
+
+def setup_logger():
+    """
+    Attach the default INFO stream handler to the `machine` logger, once.
+    """
+    global _logger_ready
+    if _logger_ready:
+        return
+    with _logger_lock:
+        if _logger_ready:
+            return
+        # 1. logger
+        logger = logging.getLogger("machine")
+        logger.setLevel(logging.INFO)
+
+        # 2. Add handler
+        steam_handler = logging.StreamHandler()
+        steam_handler.setLevel(logging.INFO)
+        formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
+        steam_handler.setFormatter(formatter)
+        logger.addHandler(steam_handler)
+        _logger_ready = True
+
+
+def storage_path():
+    """
+    Get the docker-machine storage directory
+
+    Returns:
+        the absolute path of the storage directory
+    """
+    path = os.environ.get("MACHINE_STORAGE_PATH") or DEFAULT_STORAGE_PATH
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def get_deadline(timeout=None, deadline=None):
+    """
+    Combine a relative timeout and an absolute deadline
+
+    Args:
+        timeout (float): seconds from now, or None
+        deadline (float): absolute time.time() value, or None
+    Returns:
+        the earliest absolute deadline, None if both are None
+    """
+    if timeout is None:
+        return deadline
+    end = time.time() + timeout
+    return end if deadline is None else min(end, deadline)
+
+
+def get_remaining(deadline):
+    """
+    Seconds left before an absolute deadline
+
+    Args:
+        deadline (float): absolute time.time() value, or None
+    Returns:
+        float: seconds left, 0 once passed, None if deadline is None
+    """
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+def run_parallel(func, items, concurrency=8, timeout=None, fail_fast=False, join=False):
+    """
+    Call func(item) for every item on a bounded pool of threads.
+
+    Args:
+        func (callable): called with one item
+        items (iterable): the items
+        concurrency (int): maximum number of concurrent calls
+        timeout (float): global deadline in seconds, items not done by then
+            are yielded with a CommandTimeoutError
+        fail_fast (bool): stop after the first error, items not started
+            yet are dropped
+        join (bool): at the deadline, wait for the calls in progress and
+            yield their own outcome instead of a CommandTimeoutError; the
+            generator also waits for them when closed early
+    Returns:
+        generator: (item, result, error) tuples in completion order
+    """
+    items = list(items)
+    tasks = queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+    results = queue.Queue()
+    stop = threading.Event()
+    # indexes of the calls started, the lock makes stopping atomic
+    started = set()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if stop.is_set():
+                    return
+                try:
+                    index, item = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                started.add(index)
+            try:
+                results.put((index, item, func(item), None))
+            except Exception as e:
+                results.put((index, item, None, e))
+
+    for _ in range(min(concurrency, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + timeout if timeout is not None else None
+    pending = dict(enumerate(items))
+    try:
+        while pending:
+            wait = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                # a finite wait keeps the loop interruptible on python 2
+                index, item, result, error = results.get(timeout=wait if wait is not None else 3600)
+            except queue.Empty:
+                if deadline is None:
+                    continue
+                with lock:
+                    stop.set()
+                    running = started.intersection(pending) if join else set()
+                for index in sorted(pending):
+                    if index not in running:
+                        error = CommandTimeoutError("deadline of %.1fs exceeded" % timeout)
+                        yield pending[index], None, error
+                pending = dict((index, pending[index]) for index in running)
+                deadline = None
+                continue
+            del pending[index]
+            yield item, result, error
+            if error is not None and fail_fast:
+                return
+    finally:
+        with lock:
+            stop.set()
+            running = len(started.intersection(pending)) if join else 0
+        while running:
+            try:
+                results.get(timeout=1)
+                running -= 1
+            except queue.Empty:
+                continue
+
+
+def _field(row, key):
+    """ value of key in a dict or attribute of a record """
+    if isinstance(row, dict):
+        value = row.get(key)
+    else:
+        value = getattr(row, key, None)
+    if Enum is not None and isinstance(value, Enum):
+        value = value.value
+    return value
+
+
+def _text(value):
+    if value is None:
+        return u""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return u"%s" % (value,)
+
+
+def _truncate(text, width):
+    if width is None or len(text) <= width:
+        return text
+    if width <= 3:
+        return text[:width]
+    return text[:width - 3] + u"..."
+
+
+def write_table(data,
+                keys,
+                header=None,
+                stream=None,
+                fmt="table",
+                max_width=None,
+                widths=None,
+                sort_by_key=None,
+                sort_order_reverse=False):
+    """Write rows as a text table, tab separated values or JSON to stream.
+
+    Rows are read once: in "table" format they are rendered to text while
+    column widths are computed, then written, unless `widths` is given in
+    which case each row is written as soon as it is read. "tsv" and "json"
+    are always written row by row, so data can be a generator such as
+    Machine.iter_ls().
+
+    Required Parameters:
+        data - Rows to write, dictionaries or records such as namedtuples. (Type: Iterable)
+        keys - List of keys (or attribute names) to write. (Type: List)
+
+    Optional Parameters:
+        header - The table header, defaults to keys in "tsv". (Type: List)
+        stream - File object to write to, defaults to sys.stdout. (Type: File)
+        fmt - "table", "tsv" or "json". (Type: String)
+        max_width - Cap of every column width in "table", longer values are
+            truncated. (Type: Integer)
+        widths - Fixed width of every column in "table". (Type: List)
+        sort_by_key - The key to sort by, reads all the rows first. (Type: String)
+        sort_order_reverse - Default sort order is ascending, if
+            True sort order will change to descending. (Type: Boolean)
+    """
+    if stream is None:
+        stream = sys.stdout
+    if sort_by_key:
+        data = sorted(data,
+                      key=lambda row: _field(row, sort_by_key),
+                      reverse=sort_order_reverse)
+
+    if fmt == "json":
+        stream.write(u"[")
+        separator = u"\n"
+        for row in data:
+            stream.write(separator + _text(json.dumps(dict((key, _field(row, key)) for key in keys))))
+            separator = u",\n"
+        stream.write(u"\n]\n")
+        return
+
+    if fmt == "tsv":
+        stream.write(u"\t".join(_text(x) for x in header or keys) + u"\n")
+        for row in data:
+            stream.write(u"\t".join(_text(_field(row, key)).replace(u"\t", u" ")
+                                    for key in keys) + u"\n")
+        return
+
+    if fmt != "table":
+        raise ValueError("unknown table format %s" % fmt)
+
+    def cells(values):
+        return [_truncate(_text(value), max_width) for value in values]
+
+    def line(values, column_widths):
+        return u" ".join(_truncate(value, width).ljust(width)
+                         for value, width in zip(values, column_widths)) + u"\n"
+
+    head = []
+    if header:
+        head.append(cells(header))
+        head.append([u"-" * len(name) for name in head[0]])
+
+    if widths is not None:
+        column_widths = list(widths)
+        for values in head:
+            stream.write(line(values, column_widths))
+        for row in data:
+            stream.write(line(cells(_field(row, key) for key in keys), column_widths))
+        return
+
+    rows = head
+    column_widths = [len(value) for value in head[0]] if head else [0] * len(keys)
+    for row in data:
+        values = cells(_field(row, key) for key in keys)
+        rows.append(values)
+        for index, value in enumerate(values):
+            if len(value) > column_widths[index]:
+                column_widths[index] = len(value)
+    for values in rows:
+        stream.write(line(values, column_widths))
+
+
 def format_as_table(data,
                     keys,
                     header=None,
@@ -47,47 +359,7 @@ def format_as_table(data,
         sort_order_reverse - Default sort order is ascending, if
             True sort order will change to descending. (Type: Boolean)
     """
-    # copy object
-    data = list(data)
-    # Sort the data if a sort key is specified (default sort order
-    # is ascending)
-    if sort_by_key:
-        data = sorted(data,
-                      key=itemgetter(sort_by_key),
-                      reverse=sort_order_reverse)
-
-    # If header is not empty, add header to data
-    if header:
-        # Get the length of each header and create a divider based
-        # on that length
-        header_divider = []
-        for name in header:
-            header_divider.append('-' * len(name))
-
-        # Create a list of dictionary from the keys and the header and
-        # insert it at the beginning of the list. Do the same for the
-        # divider and insert below the header.
-        header_divider = dict(zip(keys, header_divider))
-        data.insert(0, header_divider)
-        header = dict(zip(keys, header))
-        data.insert(0, header)
-
-    column_widths = []
-    for key in keys:
-        column_widths.append(max(len(str(column[key])) for column in data))
-
-    # Create a tuple pair of key and the associated column width for it
-    key_width_pair = zip(keys, column_widths)
-
-    format = ('%-*s ' * len(keys)).strip() + '\n'
-    formatted_data = ''
-    for element in data:
-        data_to_format = []
-        # Create a tuple that will be used for the formatting in
-        # width, value format
-        for pair in key_width_pair:
-            data_to_format.append(pair[1])
-            data_to_format.append(element[pair[0]])
-        formatted_data += format % tuple(data_to_format)
-    return formatted_data
-
+    stream = StringIO()
+    write_table(data, keys, header=header, stream=stream,
+                sort_by_key=sort_by_key, sort_order_reverse=sort_order_reverse)
+    return stream.getvalue()
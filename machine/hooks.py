@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import logging
+
+logger = logging.getLogger("machine")
+
+
+class CommandTrace(object):
+    """
+    A docker-machine invocation as seen by the hooks.
+
+    `argv` is the full argument vector, `pid` the process id (None if it
+    couldn't be spawned). Timings are time.time() values: `started` before
+    spawning, `spawned` once the process runs, `first_byte` when its first
+    output line arrived and `exited` when it ended, None until then.
+    `returncode` is None if the process didn't exit by itself, `expired`
+    tells if it was killed by its timeout.
+    """
+    __slots__ = ("argv", "pid", "started", "spawned", "first_byte", "exited",
+                 "returncode", "expired")
+
+    def __init__(self, argv, started):
+        self.argv = argv
+        self.pid = None
+        self.started = started
+        self.spawned = None
+        self.first_byte = None
+        self.exited = None
+        self.returncode = None
+        self.expired = False
+
+    @property
+    def verb(self):
+        return self.argv[1] if len(self.argv) > 1 else ""
+
+    @property
+    def duration(self):
+        """
+        Returns:
+            float: seconds from start to exit, None while running
+        """
+        return self.exited - self.started if self.exited is not None else None
+
+    def __repr__(self):
+        return "CommandTrace(argv=%r, pid=%r, returncode=%r, duration=%r)" % (
+            self.argv, self.pid, self.returncode, self.duration)
+
+
+class Hooks(object):
+    """
+    Base class of the hooks called around every docker-machine invocation,
+    see Machine.add_hook. Override the methods needed, they run in the
+    thread (or event loop) running the command and must be quick.
+
+    For each command on_start is called once the process is spawned, then
+    on_line for every output line, then either on_finish when it exited
+    with 0, or on_error when it exited with another code, timed out or
+    was interrupted (`error` being the exception raised, if any). on_error
+    comes without on_start when the process couldn't be spawned.
+    """
+    def on_start(self, trace):
+        pass
+
+    def on_line(self, trace, stream, line, timestamp):
+        pass
+
+    def on_finish(self, trace):
+        pass
+
+    def on_error(self, trace, error):
+        pass
+
+
+class LoggingHooks(Hooks):
+    """
+    Log failed commands, and the commands slower than `slow` seconds, with
+    their arguments and timings.
+    """
+    def __init__(self, slow=None, logger=logger):
+        self.slow = slow
+        self.logger = logger
+
+    def on_finish(self, trace):
+        if self.slow is not None and trace.duration >= self.slow:
+            self.logger.warning("slow command %s: %.3fs (first byte after %s)" % (
+                " ".join(trace.argv), trace.duration, _elapsed(trace, trace.first_byte)))
+
+    def on_error(self, trace, error):
+        self.logger.warning("command %s failed after %s: returncode=%s expired=%s error=%s" % (
+            " ".join(trace.argv), _elapsed(trace, trace.exited), trace.returncode,
+            trace.expired, error))
+
+
+def _elapsed(trace, timestamp):
+    if timestamp is None:
+        return "-"
+    return "%.3fs" % (timestamp - trace.started)
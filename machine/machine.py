@@ -1,13 +1,27 @@
 import re
-from subprocess import Popen, PIPE
+import copy
+import functools
 import json
 import os
 import logging
-
-from docker.tls import TLSConfig
-from .helper import which, format_as_table
-from configs import create_config_from_dict, SwarmConfig
-from .errors import MachineNotFoundError, MachineAlreadyExistsError
+import threading
+import time
+
+from .helper import (resolve, setup_logger, write_table, storage_path, run_parallel, get_deadline,
+                     get_remaining)
+from .configs import create_config_from_dict, SwarmConfig
+from .process import StreamingProcess, ParallelStreams, STDOUT, STDERR, Watchdog, popen
+from .records import parse_ls_row, parse_state, parse_env, State
+from . import environ
+from .coalesce import Coalescer, SingleFlight
+from .cache import LRUCache, MISSING
+from .metrics import Metrics
+from .hooks import CommandTrace
+from .monitor import FleetMonitor, ADDED, REMOVED
+from .store import FileStore
+from .ssh import CHUNK_SIZE, SSHSession, ssh_params
+from .errors import (MachineNotFoundError, MachineAlreadyExistsError, CommandTimeoutError,
+                     RollbackError)
 
 
 # Logging
@@ -17,133 +31,908 @@ logger = logging.getLogger("machine")
 LS_FIELDS = ["Name", "Active", "ActiveHost", "ActiveSwarm", "DriverName",
              "State", "URL", "Swarm", "Error",
              "DockerVersion", "ResponseTime"]
-
-
-class Machine(object):
+LS_SEPARATOR = "\t"
+# ls filters docker-machine applies itself, others are applied on the rows
+LS_FILTERS = ["driver", "state", "swarm", "label", "name"]
+
+VERSION_REGEXP = "docker-machine version (.+), build (.+)"
+CONFIG_REGEXP = """(--tlsverify\n)?--tlscacert="(.+)"\n--tlscert="(.+)"\n--tlskey="(.+)"\n-H=(.+)"""
+
+# commands without side effects, concurrent identical calls share one process
+READ_COMMANDS = ["ls", "inspect", "ip", "url", "config", "status", "version"]
+
+# commands after which the ssh connections to the machine are closed
+SSH_CLOSING_COMMANDS = ["stop", "kill", "restart", "rm"]
+
+# default timeout in seconds of each docker-machine command, None to wait forever
+DEFAULT_TIMEOUTS = {
+    "active": 60,
+    "config": 60,
+    "create": 3600,
+    "env": 60,
+    "inspect": 30,
+    "ip": 60,
+    "kill": 120,
+    "ls": 120,
+    "provision": 1800,
+    "regenerate-certs": 600,
+    "restart": 600,
+    "rm": 300,
+    "scp": None,
+    "ssh": None,
+    "start": 600,
+    "status": 60,
+    "stop": 300,
+    "upgrade": 1800,
+    "url": 60,
+    "version": 30,
+}
+
+
+def memoized(method):
     """
+    Serve method(self, machine, ...) from the result cache of the Machine,
+    entries are evicted when the machine is changed through the same object.
     """
-    def __init__(self, path="docker-machine"):
+    @functools.wraps(method)
+    def wrapper(self, machine="default", *args, **kwargs):
+        if self._results is None:
+            return method(self, machine, *args, **kwargs)
+        key = (method.__name__, machine)
+        value = self._results.get(key)
+        if value is MISSING:
+            value = method(self, machine, *args, **kwargs)
+            self._results.put(key, value)
+        # callers may modify the dicts they get
+        return copy.deepcopy(value) if isinstance(value, dict) else value
+    return wrapper
+
+
+def _filter_value(value):
+    """ the string docker-machine uses for an ls filter value, State members included """
+    return getattr(value, "value", value)
+
+
+class BaseMachine(object):
+    """
+    State and helpers shared by Machine and AsyncMachine: the binary, the
+    caches, the metrics and hooks, and the parsing of docker-machine
+    output. It runs no command itself.
+    """
+    def __init__(self, path="docker-machine", index_ttl=10, store=None, timeouts=None,
+                 cache_size=256, cache_ttl=60, hooks=None):
         """
         Args:
             path (str): path to docker-machine binary
+            index_ttl (float): seconds the machine name index used for
+                existence checks stays valid, 0 to disable caching
+            store (FileStore): answer read calls from the storage directory
+                instead of running docker-machine
+            timeouts (dict): default timeout per command, merged over DEFAULT_TIMEOUTS
+            cache_size (int): results of ip, url, config, inspect, version
+                and env kept, 0 to disable caching
+            cache_ttl (float): seconds a cached result stays valid
+            hooks (List[Hooks]): called around every docker-machine invocation
         """
-        where = which(path)
+        setup_logger()
+        where = resolve(path)
         if not where:
             raise RuntimeError("Cant find docker-machine binary (%s)" % path)
         self.path = where
+        self.store = store
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.index_ttl = index_ttl
+        self._index = None
+        self._index_expires = 0
+        self._index_stamp = None
+        self._index_lock = threading.Lock()
+        # docker clients per machine, see client
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._results = LRUCache(cache_size, cache_ttl) if cache_size else None
+        # per command counters and latencies, see Metrics
+        self.metrics = Metrics()
+        self.hooks = list(hooks or [])
+
+    def invalidate_index(self):
+        """
+        Drop the cached machine name index, next existence check will reload it.
+        """
+        with self._index_lock:
+            self._index = None
+            self._index_expires = 0
 
-    def __contains__(self, machine):
-        if machine in [x["Name"] for x in self.ls(pprint=False)]:
-            return True
+    def storage_path(self):
+        """
+        Get the docker-machine storage directory.
+
+        Returns:
+            str: absolute path of the storage directory
+        """
+        if self.store is not None:
+            return self.store.storage_path()
+        return storage_path()
+
+    def _storage_stamp(self):
+        """
+        Fingerprint of the storage directory: its path and the mtime of its
+        machines directory, which changes whenever a machine is added or removed.
+        """
+        storage = self.storage_path()
+        try:
+            mtime = os.stat(os.path.join(storage, "machines")).st_mtime
+        except OSError:
+            mtime = None
+        return storage, mtime
+
+    def _set_index(self, names, stamp=None):
+        self._index = frozenset(names)
+        self._index_stamp = stamp or self._storage_stamp()
+        self._index_expires = time.time() + self.index_ttl
+
+    def _timeout(self, cmd, timeout=None, deadline=None):
+        """
+        Seconds cmd may run: timeout or the default of the command, bounded
+        by the absolute deadline (a time.time() value).
+        """
+        if timeout is None:
+            timeout = self.timeouts.get(cmd[0] if cmd else None)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise CommandTimeoutError("deadline exceeded before running %s" % " ".join(cmd))
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def add_hook(self, hook):
+        """
+        Call hook around every docker-machine invocation, see Hooks.
+        """
+        self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        self.hooks = [x for x in self.hooks if x is not hook]
+
+    def _emit(self, event, *args):
+        for hook in self.hooks:
+            try:
+                getattr(hook, event)(*args)
+            except Exception:
+                logger.exception("%s hook failed" % event)
+
+    def _trace_exit(self, trace, returncode, expired, error=None):
+        trace.exited = time.time()
+        trace.returncode = returncode
+        trace.expired = expired
+        if returncode == 0 and not expired:
+            self._emit("on_finish", trace)
         else:
-            return False
+            self._emit("on_error", trace, error)
+
+    def _parse_match(self, stdout, regexp):
+        cleaned = stdout.strip()
+        with self.metrics.parsing("match"):
+            match = re.match(regexp, cleaned)
+        if not match:
+            raise RuntimeError("can't parse output (\"%s\")" % cleaned)
+        return match
+
+    def _cached_client(self, machine):
+        with self._clients_lock:
+            entry = self._clients.get(machine)
+        if entry is not None and entry[0] == self._certs_stamp(entry[1]):
+            return entry[2]
+        return None
+
+    def _new_client(self, machine, params, **kwargs):
+        params.update(kwargs)
+        import docker
+
+        # docker-py >= 2 renamed Client to APIClient
+        client_class = getattr(docker, "APIClient", None) or docker.Client
+        client = client_class(**params)
+        stamp = self._certs_stamp(params["tls"])
+        with self._clients_lock:
+            old = self._clients.get(machine)
+            if old is not None and old[0] == self._certs_stamp(old[1]):
+                # another caller built one meanwhile and may be using it already
+                unused, client = client, old[2]
+            else:
+                unused = old[2] if old is not None else None
+                self._clients[machine] = (stamp, params["tls"], client)
+        if unused is not None:
+            self._close_client(unused)
+        return client
+
+    def _certs_stamp(self, tls):
+        """
+        mtimes of the certificate files of a TLSConfig
+        """
+        paths = [tls.ca_cert] + list(tls.cert or [])
+        stamp = []
+        for path in paths:
+            try:
+                stamp.append(os.stat(path).st_mtime)
+            except (OSError, TypeError):
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _close_client(self, client):
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+
+    def invalidate_client(self, machine=None):
+        """
+        Drop the cached docker client of machine, or all clients if machine is None.
+        """
+        with self._clients_lock:
+            if machine is None:
+                clients = list(self._clients.values())
+                self._clients.clear()
+            else:
+                entry = self._clients.pop(machine, None)
+                clients = [entry] if entry is not None else []
+        for entry in clients:
+            self._close_client(entry[2])
+
+    def invalidate_cache(self, machine=None):
+        """
+        Drop the cached ip, url, config, inspect and env results of machine, or
+        every cached result (version included) if machine is None.
+        """
+        if self._results is not None:
+            if machine is None:
+                self._results.clear()
+            else:
+                self._results.evict(machine)
+
+    def cache_info(self):
+        """
+        Returns:
+            CacheInfo: hits, misses, maxsize and currsize of the result cache,
+                None when caching is disabled
+        """
+        return self._results.info() if self._results is not None else None
+
+    def _parse_config(self, match):
+        """
+        Turn a match of CONFIG_REGEXP on `docker-machine config` output into
+        the dict returned by FileStore.config.
+        """
+        tlsverify, tlscacert, tlscert, tlskey, host = match.group(1, 2, 3, 4, 5)
+        return {
+            "tlsverify": bool(tlsverify),
+            "tlscacert": tlscacert,
+            "tlscert": tlscert,
+            "tlskey": tlskey,
+            "host": host
+        }
+
+    def _config_params(self, config):
+        from docker.tls import TLSConfig
+
+        tlsverify = config.get("tlsverify", True)
+        tlscacert, tlscert, tlskey, host = \
+            config["tlscacert"], config["tlscert"], config["tlskey"], config["host"]
+        params = {
+            'base_url': host.replace('tcp://', 'https://') if tlsverify else host,
+            'tls': TLSConfig(
+                client_cert=(tlscert, tlskey),
+                ca_cert=tlscacert,
+                verify=True
+            )
+        }
+        return params
+
+    def _print_ls(self, machines):
+        write_table(data=machines,
+                    keys=LS_FIELDS,
+                    header=LS_FIELDS)
 
-    def _run(self, cmd, raise_error=True, verbose=False):
+    def _ls_cmd(self, timeout, filters=None):
+        fields = LS_SEPARATOR.join(["{{.%s}}" % i for i in LS_FIELDS])
+        cmd = ["ls", "-t", str(timeout), "-f", fields]
+        for key, values in sorted((filters or {}).items()):
+            if key not in LS_FILTERS:
+                continue
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            for value in values:
+                cmd.extend(["--filter", "%s=%s" % (key, _filter_value(value))])
+        return cmd
+
+    def _row_filters(self, filters):
+        """
+        The filters docker-machine can't apply, as {field: set of values}.
+        """
+        row_filters = {}
+        for key, values in (filters or {}).items():
+            if key in LS_FILTERS:
+                continue
+            if key not in LS_FIELDS:
+                raise ValueError("unknown ls filter %s" % key)
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            row_filters[key] = set(str(_filter_value(value)) for value in values)
+        return row_filters
+
+    def _match_row(self, machine, row_filters):
+        for key, values in row_filters.items():
+            if machine.get(key) not in values:
+                return False
+        return True
+
+    def _parse_ls(self, stdout, filters=None):
+        """
+        Parse the output of the `ls` command built by _ls_cmd, without
+        filters the names found refresh the machine index.
+        """
+        with self.metrics.parsing("ls"):
+            return self._parse_ls_rows(stdout, filters)
+
+    def _parse_ls_rows(self, stdout, filters=None):
+        row_filters = self._row_filters(filters)
+        machines = []
+        for line in stdout.split("\n"):
+            machine = {LS_FIELDS[index]: value for index, value in enumerate(line.split(LS_SEPARATOR))}
+            if machine.get("Name") and self._match_row(machine, row_filters):
+                machines.append(machine)
+        if not filters:
+            with self._index_lock:
+                self._set_index([x["Name"] for x in machines])
+        return machines
+
+    def _create_args(self, driver_name, driver_config={}, engine_opts=[],
+                     engine_labels=[], swarm=False, swarm_options={}):
+        """
+        Build the `create` command without the machine name, see create
+        for the arguments.
+        """
+        cmd = ['create']
+        driver_config = create_config_from_dict(driver_name, driver_config)
+
+        # Driver options
+        if driver_config is None:
+            cmd.extend(['--driver', 'none', '--url', 'localhost'])
+        else:
+            cmd.extend(driver_config.args())
+
+        # Engine options
+        if engine_opts:
+            for opt in engine_opts:
+                cmd.append("--engine-opt={}".format(opt))
+
+        # Engine labels
+        if engine_labels:
+            for label in engine_labels:
+                cmd.append("--engine-label={}".format(label))
+
+        # Swarm and swarm options
+        if swarm:
+            cmd.append("--swarm")
+        if swarm_options:
+            swarm_config = SwarmConfig(**swarm_options)
+            cmd.extend(swarm_config.args())
+
+        return cmd
+
+
+class Machine(BaseMachine):
+    """
+    """
+    def __init__(self, path="docker-machine", index_ttl=10, store=None, timeouts=None,
+                 coalesce_window=None, status_ttl=2, singleflight=True,
+                 cache_size=256, cache_ttl=60, hooks=None, ssh_path="ssh",
+                 ssh_idle_timeout=300):
+        """
+        Args:
+            path (str): path to docker-machine binary
+            index_ttl (float): seconds the machine name index used for
+                existence checks stays valid, 0 to disable caching
+            store (FileStore): answer read calls from the storage directory
+                instead of running docker-machine
+            timeouts (dict): default timeout per command, merged over DEFAULT_TIMEOUTS
+            coalesce_window (float): when set, start, stop, kill, restart and rm
+                calls made within this many seconds run as one docker-machine command
+            status_ttl (float): seconds the fleet state snapshot of status_many
+                stays valid, 0 to disable caching
+            singleflight (bool): concurrent identical READ_COMMANDS share a
+                single docker-machine process and its output
+            cache_size (int): results of ip, url, config, inspect and version
+                kept, 0 to disable caching
+            cache_ttl (float): seconds a cached result stays valid
+            hooks (List[Hooks]): called around every docker-machine invocation
+            ssh_path (str): ssh client used by ssh and ssh_session
+            ssh_idle_timeout (int): seconds an unused ssh connection stays open
+        """
+        super(Machine, self).__init__(path=path, index_ttl=index_ttl, store=store,
+                                      timeouts=timeouts, cache_size=cache_size,
+                                      cache_ttl=cache_ttl, hooks=hooks)
+        # names shared by the calls of a batch, see map
+        self._batch = threading.local()
+        self.status_ttl = status_ttl
+        self._states = None
+        self._states_expires = 0
+        self._states_lock = threading.Lock()
+        self._monitor = None
+        self._watcher = None
+        self._coalescer = None
+        if coalesce_window:
+            self._coalescer = Coalescer(self._run_many, window=coalesce_window)
+        self._flights = SingleFlight() if singleflight else None
+        # multiplexed ssh connections per machine, see ssh_session
+        self.ssh_path = ssh_path
+        self.ssh_idle_timeout = ssh_idle_timeout
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def __contains__(self, machine):
+        return machine in self._names()
+
+    def invalidate_index(self):
+        """
+        Drop the cached machine name index, next existence check will reload it.
+        """
+        super(Machine, self).invalidate_index()
+        if self._watcher is not None:
+            # don't wait for the watcher to see a machine we just added or removed
+            self._watcher.scan()
+        if self._monitor is not None:
+            self._monitor.invalidate()
+
+    def _names(self, deadline=None):
+        """
+        Get the names of all machines, served from the index while it is fresh.
+
+        Args:
+            deadline (float): absolute time.time() a refresh must finish by
+        Returns:
+            frozenset: machine names
+        """
+        names = getattr(self._batch, "names", None)
+        if names is not None:
+            return names
+        if self._watcher is not None:
+            return self._watcher.names()
+        if self._monitor is not None and self._monitor.names() is not None:
+            return self._monitor.names()
+        if self.store is not None:
+            return self.store.names()
+        with self._index_lock:
+            stamp = self._storage_stamp()
+            if self._index is not None and stamp == self._index_stamp \
+                    and time.time() < self._index_expires:
+                return self._index
+            # `ls -q` only reads the store, it doesn't probe every daemon
+            stdout, _, _ = self._run(["ls", "-q"], deadline=deadline)
+            self._set_index(stdout.split(), stamp)
+            return self._index
+
+    def map(self, method, machines, concurrency=8, timeout=None, fail_fast=False, **kwargs):
+        """
+        Run a per-machine method on many machines in parallel.
+
+        The existence of the machines is checked once for the whole batch,
+        unknown machines fail with MachineNotFoundError without running anything.
+
+        Args:
+            method (str or callable): name of a Machine method (`"restart"`)
+                or a callable taking the `machine` keyword
+            machines (List[str]): names of the machines
+            concurrency (int): maximum number of commands running at once
+            timeout (float): global deadline in seconds for the whole batch
+            fail_fast (bool): stop at the first error
+            kwargs: extra arguments given to method
+        Returns:
+            generator: (machine, result, error) tuples as commands finish
+        """
+        # the existence check counts in the global deadline
+        deadline = get_deadline(timeout)
+        if not callable(method):
+            # commands of the batch are killed at the global deadline
+            kwargs.setdefault("deadline", deadline)
+            method = getattr(self, method)
+        self.invalidate_index()
+        names = self._names(deadline)
+
+        def call(machine):
+            if machine not in names:
+                raise MachineNotFoundError("No machine named %s found" % machine)
+            self._batch.names = names
+            try:
+                return method(machine=machine, **kwargs)
+            finally:
+                self._batch.names = None
+
+        return run_parallel(call, machines, concurrency=concurrency,
+                            timeout=get_remaining(deadline), fail_fast=fail_fast)
+
+    def bulk(self, method, machines, concurrency=8, timeout=None, fail_fast=False, **kwargs):
+        """
+        Same as map but wait for the whole batch.
+
+        Returns:
+            tuple: dict of results and dict of errors, both keyed by machine name
+        """
+        results, errors = {}, {}
+        for machine, result, error in self.map(method, machines, concurrency=concurrency,
+                                               timeout=timeout, fail_fast=fail_fast, **kwargs):
+            if error is None:
+                results[machine] = result
+            else:
+                errors[machine] = error
+        return results, errors
+
+    def _run(self, cmd, raise_error=True, verbose=False, callback=None, timeout=None, deadline=None):
         """
         Run a docker-machine command, optionally raise error if error code != 0
 
         Args:
             cmd (List[str]): a list of the docker-machine command with the arguments to run
             raise_error (bool): raise an exception on non 0 return code
+            verbose (bool): log stdout lines as they come
+            callback (callable): called with (stream, line, timestamp) for every output line
+            timeout (float): seconds before the process group is killed,
+                defaults to the timeout of the command in self.timeouts
+            deadline (float): absolute time.time() the command must finish by
         Returns:
             tuple: stdout, stderr, error_code
         """
-        cmd = [self.path] + cmd
-        p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        if verbose:
-            for line in iter(p.stdout.readline, ""):
-                logger.info(line.replace("\n", " "))
-        stdout, stderr = p.communicate()
-        error_code = p.returncode
+        timeout = self._timeout(cmd, timeout, deadline)
+        if verbose or callback is not None:
+            stdout, stderr, error_code, expired = self._run_streaming(cmd, verbose, callback, timeout)
+        elif self._flights is not None and cmd and cmd[0] in READ_COMMANDS:
+            stdout, stderr, error_code, expired = self._flights.do(
+                tuple(cmd), lambda: self._communicate(cmd, timeout), timeout)
+        else:
+            stdout, stderr, error_code, expired = self._communicate(cmd, timeout)
+        if expired:
+            raise CommandTimeoutError("cmd %s timed out after %.1fs" % (" ".join(cmd), timeout))
         if raise_error and error_code:
-            raise RuntimeError("cmd returned error %s: %s" % (error_code, stderr.decode('utf-8').strip()))
-        return stdout.decode('utf-8'), stderr.decode('utf-8'), error_code
+            raise RuntimeError("cmd returned error %s: %s" % (error_code, stderr.strip()))
+        return stdout, stderr, error_code
+
+    def _communicate(self, cmd, timeout=None):
+        if self.hooks:
+            # hooks want the pid and the time of the first line
+            return self._run_streaming(cmd, timeout=timeout)
+        verb = cmd[0] if cmd else ""
+        started = self.metrics.started(verb)
+        stdout, stderr, watchdog = b"", b"", None
+        try:
+            p = popen([self.path] + cmd)
+            with Watchdog(p, timeout) as watchdog:
+                stdout, stderr = p.communicate()
+        finally:
+            self.metrics.finished(verb, started, p.returncode if watchdog else None,
+                                  len(stdout), len(stderr), watchdog is not None and watchdog.expired)
+        return stdout.decode('utf-8'), stderr.decode('utf-8'), p.returncode, watchdog.expired
+
+    def _run_streaming(self, cmd, verbose=False, callback=None, timeout=None):
+        stdout, stderr = [], []
+        process = self.stream(cmd, callback=callback, timeout=timeout)
+        try:
+            for stream, line, timestamp in process:
+                if stream == STDOUT:
+                    stdout.append(line)
+                    if verbose:
+                        logger.info(line)
+                else:
+                    stderr.append(line)
+        except BaseException:
+            process.kill()
+            raise
+        return "\n".join(stdout), "\n".join(stderr), process.returncode, process.expired
+
+    def stream(self, cmd, callback=None, timeout=None, deadline=None):
+        """
+        Run a docker-machine command and stream its output, stdout and
+        stderr are read concurrently so the command never blocks on a full pipe.
+
+        Args:
+            cmd (List[str]): a list of the docker-machine command with the arguments to run
+            callback (callable): called with (stream, line, timestamp) for every line
+            timeout (float): seconds before the process group is killed,
+                defaults to the timeout of the command in self.timeouts
+            deadline (float): absolute time.time() the command must finish by
+        Returns:
+            StreamingProcess: iterate it for (stream, line, timestamp) events,
+                its `returncode` is set once the output is consumed
+        """
+        timeout = self._timeout(cmd, timeout, deadline)
+        argv = [self.path] + cmd
+        verb = cmd[0] if cmd else ""
+        started = self.metrics.started(verb)
+        trace = CommandTrace(argv, started) if self.hooks else None
+
+        def on_line(stream, line, timestamp):
+            if trace.first_byte is None:
+                trace.first_byte = timestamp
+            self._emit("on_line", trace, stream, line, timestamp)
+            if callback is not None:
+                callback(stream, line, timestamp)
+
+        def on_exit(process):
+            self.metrics.finished(verb, started, process.returncode, process.bytes[STDOUT],
+                                  process.bytes[STDERR], process.expired)
+            if trace is not None:
+                self._trace_exit(trace, process.returncode, process.expired)
+
+        try:
+            process = StreamingProcess(argv, callback=on_line if trace is not None else callback,
+                                       timeout=timeout, on_exit=on_exit)
+        except BaseException as e:
+            self.metrics.finished(verb, started)
+            if trace is not None:
+                self._trace_exit(trace, None, False, e)
+            raise
+        if trace is not None:
+            trace.pid, trace.spawned = process.pid, time.time()
+            self._emit("on_start", trace)
+        return process
+
+    def _run_action(self, cmd, machine, deadline=None):
+        """
+        Run cmd on machine, through the coalescing queue when enabled.
+
+        Args:
+            cmd (List[str]): the docker-machine command without the machine name
+        Returns:
+            bool: True if successful
+        """
+        try:
+            if self._coalescer is not None:
+                return self._coalescer.run(cmd, machine, deadline=deadline)
+            self._run(cmd + [machine], deadline=deadline)
+            return True
+        finally:
+            if cmd[0] in SSH_CLOSING_COMMANDS:
+                self.close_ssh(machine)
+            self.invalidate_cache(machine)
+            self.invalidate_states()
+
+    def _run_many(self, cmd, machines, deadline=None):
+        """
+        Run cmd once for all the machines, docker-machine accepts many names
+        for start, stop, kill, restart and rm.
+
+        A machine failed when the error output mentions its name, when no
+        name is mentioned every machine gets the error.
+
+        Args:
+            cmd (List[str]): the docker-machine command without machine names
+            machines (List[str]): names of the machines
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            tuple: dict of results and dict of errors, both keyed by machine name
+        """
+        results, errors = {}, {}
+        names = self._names(deadline)
+        found = []
+        for machine in machines:
+            if machine not in names:
+                errors[machine] = MachineNotFoundError("No machine named %s found" % machine)
+            elif machine not in found:
+                found.append(machine)
+        if not found:
+            return results, errors
+        try:
+            stdout, stderr, error_code = self._run(cmd + found, raise_error=False, deadline=deadline)
+        finally:
+            for machine in found:
+                if cmd[0] in SSH_CLOSING_COMMANDS:
+                    self.close_ssh(machine)
+                self.invalidate_cache(machine)
+            self.invalidate_states()
+        failed = {}
+        if error_code:
+            lines = [line for line in stderr.splitlines() if line.strip()]
+            for machine in found:
+                regexp = re.compile(r"(?<![\w.-])%s(?![\w.-])" % re.escape(machine))
+                mentions = [line for line in lines if regexp.search(line)]
+                if mentions:
+                    failed[machine] = "\n".join(mentions)
+            if not failed:
+                failed = dict((machine, stderr.strip()) for machine in found)
+        for machine in found:
+            if machine in failed:
+                errors[machine] = RuntimeError("cmd returned error %s: %s" % (error_code, failed[machine]))
+            else:
+                results[machine] = True
+        return results, errors
+
+    def start_many(self, machines, timeout=None, deadline=None):
+        """
+        Start many machines with a single docker-machine command.
+
+        Args:
+            machines (List[str]): names of the machines
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            tuple: dict of results and dict of errors, both keyed by machine name
+        """
+        return self._run_many(["start"], machines, deadline=get_deadline(timeout, deadline))
+
+    def stop_many(self, machines, timeout=None, deadline=None):
+        """
+        Stop many machines with a single docker-machine command, see start_many.
+        """
+        return self._run_many(["stop"], machines, deadline=get_deadline(timeout, deadline))
 
-    def _match(self, cmd, regexp):
+    def kill_many(self, machines, timeout=None, deadline=None):
+        """
+        Kill many machines with a single docker-machine command, see start_many.
+        """
+        return self._run_many(["kill"], machines, deadline=get_deadline(timeout, deadline))
+
+    def restart_many(self, machines, timeout=None, deadline=None):
+        """
+        Restart many machines with a single docker-machine command, see start_many.
+        """
+        return self._run_many(["restart"], machines, deadline=get_deadline(timeout, deadline))
+
+    def rm_many(self, machines, force=False, timeout=None, deadline=None):
+        """
+        Remove many machines with a single docker-machine command, see start_many.
+
+        Args:
+            force (bool): Remove local configuration even if machines cannot be removed
+        """
+        f = ["-f"] if force else []
+        try:
+            return self._run_many(["rm", "-y"] + f, machines,
+                                  deadline=get_deadline(timeout, deadline))
+        finally:
+            self.invalidate_index()
+            for machine in machines:
+                self.invalidate_client(machine)
+
+    def _match(self, cmd, regexp, deadline=None):
         """
         Run cmd and match regular expression regexp on it, return results.
 
         Args:
             cmd (List[str]): docker-machine command to run
             regexp (str): regular expression to match with
+            deadline (float): absolute time.time() the command must finish by
         Return:
             bool or regexp match
         """
-        stdout, stderr, errorcode = self._run(cmd)
-        cleaned = stdout.strip()
-        match = re.match(regexp, cleaned)
-        if not match:
-            raise RuntimeError("can't parse output (\"%s\")" % cleaned)
-        return match
+        stdout, stderr, errorcode = self._run(cmd, deadline=deadline)
+        return self._parse_match(stdout, regexp)
 
-    def version(self):
+    def version(self, timeout=None, deadline=None):
         """
         Get the docker-machine binary version.
 
+        Args:
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             str: the docker-machine binary version
 
         """
-        cmd = ["version"]
-        regexp = "docker-machine version (.+), build (.+)"
-        match = self._match(cmd, regexp)
-        return match.group(1)
-
-    def config(self, machine="default"):
+        version = self._results.get(("version",)) if self._results is not None else MISSING
+        if version is MISSING:
+            cmd = ["version"]
+            match = self._match(cmd, VERSION_REGEXP, deadline=get_deadline(timeout, deadline))
+            version = match.group(1)
+            if self._results is not None:
+                self._results.put(("version",), version)
+        return version
+
+    @memoized
+    def config(self, machine="default", timeout=None, deadline=None):
         """
         Returns the docker configuration for the given machine.
 
         Args:
             machine: The machine name
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             dict: base_url, tls
         """
-        cmd = ["config", machine]
-        regexp = """(--tlsverify\n)?--tlscacert="(.+)"\n--tlscert="(.+)"\n--tlskey="(.+)"\n-H=(.+)"""
-        match = self._match(cmd, regexp)
-        tlsverify, tlscacert, tlscert, tlskey, host = match.group(1, 2, 3, 4, 5)
-        tlsverify = bool(tlsverify)
+        config = self.store.config(machine) if self.store is not None else None
+        if not config:
+            cmd = ["config", machine]
+            match = self._match(cmd, CONFIG_REGEXP, deadline=get_deadline(timeout, deadline))
+            config = self._parse_config(match)
+        return self._config_params(config)
+
+    def client(self, machine="default", timeout=None, deadline=None, **kwargs):
+        """
+        Get a docker client for the machine, shared by every caller.
 
-        params = {
-            'base_url': host.replace('tcp://', 'https://') if tlsverify else host,
-            'tls': TLSConfig(
-                client_cert=(tlscert, tlskey),
-                ca_cert=tlscacert,
-                verify=True
-            )
-        }
-        return params
+        The client keeps its HTTPS connections alive and its TLS material is
+        loaded once. It is rebuilt when the certificates change on disk, by
+        regenerate_certs, or dropped by rm and invalidate_client.
 
-    def ls(self, timeout=10, pprint=True):
+        Args:
+            machine (str): the name of the machine
+            timeout (float): seconds the call may take if the client must be built
+            deadline (float): absolute time.time() the call must finish by
+            kwargs: extra arguments of docker.Client, used when the client is built
+        Returns:
+            docker.Client: the client
+        """
+        client = self._cached_client(machine)
+        if client is None:
+            params = self.config(machine, timeout=timeout, deadline=deadline)
+            client = self._new_client(machine, params, **kwargs)
+        return client
+
+    def ls(self, timeout=10, pprint=True, deadline=None, filters=None):
         """
         List machines.
 
+        Filters in LS_FILTERS (driver, state, swarm, label, name) are given
+        to docker-machine so it only probes the matching machines, any other
+        key must be one of LS_FIELDS and is matched on the rows. A value can
+        be a list to match any of its items.
+
+        Args:
+            timeout (int): seconds docker-machine waits for each daemon, the
+                command itself is bounded by self.timeouts["ls"]
+            pprint (bool): print the machines as a table
+            deadline (float): absolute time.time() the call must finish by
+            filters (dict): for instance {"driver": "amazonec2", "state": "Running"}
         Returns:
             list: of machines
         """
-        seperator = "\t"
-        fields = seperator.join(["{{.%s}}" % i for i in LS_FIELDS])
-        cmd = ["ls", "-t", str(timeout), "-f", fields]
-        stdout, stderr, errorcode = self._run(cmd)
-        machines = []
-        for line in stdout.split("\n"):
-            machine = {LS_FIELDS[index]: value for index, value in enumerate(line.split(seperator))}
-            if machine.get("Name"):
-                machines.append(machine)
+        cmd = self._ls_cmd(timeout, filters)
+        stdout, stderr, errorcode = self._run(cmd, deadline=deadline)
+        machines = self._parse_ls(stdout, filters)
         if pprint:
-            print(format_as_table(data=machines,
-                                  keys=LS_FIELDS,
-                                  header=LS_FIELDS,
-                                  sort_by_key=None,
-                                  sort_order_reverse=False))
+            self._print_ls(machines)
         return machines
 
-    def exists(self, machine="default"):
+    def iter_ls(self, timeout=10, deadline=None, filters=None):
+        """
+        List machines, yielding each one as soon as docker-machine prints it.
+
+        Args:
+            timeout (int): seconds docker-machine waits for each daemon
+            deadline (float): absolute time.time() the call must finish by
+            filters (dict): see ls
+        Returns:
+            generator: of MachineRecord
+        """
+        process = self.stream(self._ls_cmd(timeout, filters), deadline=deadline)
+        row_filters = self._row_filters(filters)
+        names, stderr = [], []
+        try:
+            for stream, line, timestamp in process:
+                if stream != STDOUT:
+                    stderr.append(line)
+                    continue
+                values = line.split(LS_SEPARATOR)
+                if row_filters and not self._match_row(dict(zip(LS_FIELDS, values)), row_filters):
+                    continue
+                record = parse_ls_row(values)
+                if record is not None:
+                    names.append(record.name)
+                    yield record
+        finally:
+            # the consumer stopped early
+            process.kill()
+        if process.expired:
+            raise CommandTimeoutError("cmd ls timed out")
+        if process.returncode:
+            raise RuntimeError("cmd returned error %s: %s" % (process.returncode, "\n".join(stderr).strip()))
+        if not filters:
+            with self._index_lock:
+                self._set_index(names)
+
+    def exists(self, machine="default", deadline=None):
         """
         Checks if machine exists.
 
         Args:
             machine (str): name of the machine
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool
         """
@@ -153,240 +942,579 @@ class Machine(object):
         #     if line == machine:
         #         return True
         # return False
-        if machine in self:
+        if machine in self._names(deadline):
             return True
         else:
             return False
 
-    def check_if_exists(self, machine="default"):
-        if machine in self:
+    def check_if_exists(self, machine="default", deadline=None):
+        if machine in self._names(deadline):
             return True
         else:
             raise MachineNotFoundError("No machine named %s found" % machine)
 
-    def status(self, machine="default"):
+    def status(self, machine="default", timeout=None, deadline=None):
         """
         Get the status for the machine.
 
         Args:
             machine (str): the name of the machine
-
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: status of machine
 
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
+            records = self._monitor.snapshot() if self._monitor is not None else None
+            if records is not None and machine in records:
+                return records[machine].state == State.RUNNING
             cmd = ["status", machine]
-            stdout, _, _ = self._run(cmd)
+            stdout, _, _ = self._run(cmd, deadline=deadline)
             return stdout.strip() == "Running"
 
-    def stop(self, machine="default"):
+    def status_many(self, machines=None, timeout=10, deadline=None):
+        """
+        Get the state of many machines from a single `ls` listing only names
+        and states. The listing is kept for status_ttl seconds and shared by
+        the calls made meanwhile.
+
+        Args:
+            machines (List[str]): names of the machines, None for all of them
+            timeout (int): seconds docker-machine waits for each daemon
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            dict: State by machine name, unknown machines are left out
+        """
+        records = self._monitor.snapshot() if self._monitor is not None else None
+        if records is not None:
+            states = dict((name, record.state) for name, record in records.items())
+        else:
+            states = self._fetch_states(timeout, deadline)
+        if machines is None:
+            return states
+        return dict((machine, states[machine]) for machine in machines if machine in states)
+
+    def _fetch_states(self, timeout=10, deadline=None):
+        with self._states_lock:
+            if self._states is None or time.time() >= self._states_expires:
+                cmd = ["ls", "-t", str(timeout), "-f", "{{.Name}}%s{{.State}}" % LS_SEPARATOR]
+                stdout, _, _ = self._run(cmd, deadline=deadline)
+                states = {}
+                for line in stdout.splitlines():
+                    values = line.split(LS_SEPARATOR)
+                    if values[0]:
+                        states[values[0]] = parse_state(values[1] if len(values) > 1 else "")
+                self._states = states
+                self._states_expires = time.time() + self.status_ttl
+                with self._index_lock:
+                    self._set_index(states)
+            return dict(self._states)
+
+    def invalidate_states(self):
+        """
+        Drop the fleet state snapshot of status_many.
+        """
+        with self._states_lock:
+            self._states = None
+        if self._monitor is not None:
+            self._monitor.invalidate()
+
+    def monitor(self, fast_interval=1, slow_interval=30, timeout=10):
+        """
+        Start a FleetMonitor refreshing the state of every machine in the
+        background. While it runs, status, status_many, exists and `in`
+        answer from its last listing instead of running docker-machine.
+
+        Args:
+            fast_interval (float): seconds between listings while the fleet changes
+            slow_interval (float): maximum seconds between listings
+            timeout (int): seconds docker-machine waits for each daemon
+        Returns:
+            FleetMonitor: the monitor, subscribe to it for change events
+        """
+        if self._monitor is None:
+            self._monitor = FleetMonitor(self, fast_interval=fast_interval,
+                                         slow_interval=slow_interval, timeout=timeout)
+            self._monitor.start()
+        return self._monitor
+
+    def stop_monitor(self):
+        """
+        Stop the FleetMonitor started by monitor.
+        """
+        monitor, self._monitor = self._monitor, None
+        if monitor is not None:
+            monitor.stop()
+
+    def watch(self, interval=2, use_inotify=True):
+        """
+        Start a StoreWatcher following the storage directory. While it runs,
+        exists and `in` answer from its index, and only the caches of the
+        machines whose files change are dropped.
+
+        Args:
+            interval (float): seconds between scans when inotify isn't available
+            use_inotify (bool): False to always poll the storage directory
+        Returns:
+            StoreWatcher: the watcher
+        """
+        from .watcher import StoreWatcher
+
+        if self._watcher is None:
+            watcher = StoreWatcher(self.store or FileStore(), interval=interval,
+                                   use_inotify=use_inotify)
+            watcher.callback = lambda event: self._on_store_change(watcher, event)
+            watcher.start()
+            self._watcher = watcher
+        return self._watcher
+
+    def stop_watch(self):
+        """
+        Stop the StoreWatcher started by watch.
+        """
+        watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher.stop()
+
+    def _on_store_change(self, watcher, event):
+        """
+        Drop what a change of the storage directory made stale.
+        """
+        if event.kind in (ADDED, REMOVED):
+            with self._index_lock:
+                self._set_index(watcher.names())
+        if event.kind != ADDED:
+            # new certificates or address, or machine gone
+            self.invalidate_client(event.name)
+            self.close_ssh(event.name)
+        self.invalidate_cache(event.name)
+        with self._states_lock:
+            if self._states is not None:
+                if event.kind == REMOVED:
+                    self._states.pop(event.name, None)
+                else:
+                    self._states = None
+        if self._monitor is not None:
+            self._monitor.invalidate()
+
+    def stop(self, machine="default", timeout=None, deadline=None):
         """
         Stop the specified machine.
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
-            cmd = ["stop", machine]
-            self._run(cmd)
-            return True
+        if self.check_if_exists(machine, deadline=deadline):
+            return self._run_action(["stop"], machine, deadline=deadline)
 
-    def start(self, machine="default"):
+    def start(self, machine="default", timeout=None, deadline=None):
         """
         Start the specified machine.
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
-            cmd = ["start", machine]
-            self._run(cmd)
-            return True
+        if self.check_if_exists(machine, deadline=deadline):
+            return self._run_action(["start"], machine, deadline=deadline)
 
-    def provision(self, machine="default"):
+    def provision(self, machine="default", callback=None, timeout=None, deadline=None):
         """
         Provision the specified machine.
 
         Args:
             machine (str): the name of the machine
+            callback (callable): called with (stream, line, timestamp) for every output line
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
             cmd = ["provision", machine]
-            self._run(cmd)
+            try:
+                self._run(cmd, callback=callback, deadline=deadline)
+            finally:
+                self.invalidate_cache(machine)
             return True
 
-    def regenerate_certs(self, machine="default"):
+    def regenerate_certs(self, machine="default", timeout=None, deadline=None):
         """
         Regenerate certificats for the specified machine.
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
             cmd = ["regenerate-certs", "--force", machine]
-            self._run(cmd)
+            try:
+                self._run(cmd, deadline=deadline)
+            finally:
+                self.invalidate_cache(machine)
+                self.invalidate_client(machine)
             return True
 
-    def rm(self, machine="default", force=False):
+    def rm(self, machine="default", force=False, timeout=None, deadline=None):
         """
         Remove the specified machine.
 
         Args:
             machine (str): the name of the machine
             force (bool): Remove local configuration even if machine cannot be removed
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
             f = ["-f"] if force else []
-            cmd = ["rm", "-y"] + f + [machine]
-            self._run(cmd)
-            return True
+            try:
+                return self._run_action(["rm", "-y"] + f, machine, deadline=deadline)
+            finally:
+                self.invalidate_index()
+                self.invalidate_client(machine)
 
-    def env(self, machine="default", swarm=False):
+    def env(self, machine="default", swarm=False, timeout=None, deadline=None):
         """
         Get the environment variables to configure docker to connect
-        to the specified docker machine.
+        to the specified docker machine, cached like ip and url.
 
         Args:
             machine (str): the name of the machine
+            swarm (bool): variables of the swarm master instead of the docker daemon
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
-            str: A set of environment variables
+            dict: value by variable name (DOCKER_HOST, DOCKER_CERT_PATH...)
         """
-        # be sure machine exists
-        if self.check_if_exists(machine):
+        key = ("env", machine, bool(swarm))
+        variables = self._results.get(key) if self._results is not None else MISSING
+        if variables is MISSING:
+            deadline = get_deadline(timeout, deadline)
+            # be sure machine exists
+            self.check_if_exists(machine, deadline=deadline)
             cmd = ["env", machine]
             if swarm:
                 cmd.append("--swarm")
-            stdout, _, _ = self._run(cmd)
-            return stdout.split()
+            stdout, _, _ = self._run(cmd, deadline=deadline)
+            with self.metrics.parsing("env"):
+                variables = parse_env(stdout)
+            if self._results is not None:
+                self._results.put(key, variables)
+        return dict(variables)
+
+    def subprocess_env(self, machine="default", swarm=False, base=None, timeout=None,
+                       deadline=None):
+        """
+        Get an environment targeting the machine, to give to subprocess.
 
-    def eval_env(self, machine="default", swarm=False):
+        Args:
+            machine (str): the name of the machine
+            swarm (bool): target the swarm master instead of the docker daemon
+            base (dict): environment to extend, defaults to the environment
+                of the current thread (see scoped_env)
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            dict: the environment
         """
+        environment = dict(base) if base is not None else environ.current()
+        environment.update(self.env(machine, swarm=swarm, timeout=timeout, deadline=deadline))
+        return environment
+
+    def scoped_env(self, machine="default", swarm=False, timeout=None, deadline=None):
         """
-        tmp = self.env(machine=machine, swarm=swarm)
-        env_tuple = map(lambda x: tuple(x.split("=")), [tmp[1], tmp[3], tmp[5], tmp[7]])
-        for var, value in env_tuple:
-            os.environ[var] = value.replace('"', "")
+        Context manager targeting the machine from the current thread only,
+        os.environ is left untouched::
+
+            with m.scoped_env("dev") as env:
+                subprocess.check_call(["docker", "ps"], env=env)
+
+        Inside the block subprocess_env and machine.environ.current() extend
+        this environment.
+
+        Returns:
+            context manager yielding the environment
+        """
+        return environ.scoped(self.env(machine, swarm=swarm, timeout=timeout, deadline=deadline))
+
+    def eval_env(self, machine="default", swarm=False, timeout=None, deadline=None):
+        """
+        Set the environment variables of the machine in os.environ, for the
+        whole process. Prefer scoped_env or subprocess_env from threads.
+        """
+        os.environ.update(self.env(machine=machine, swarm=swarm, timeout=timeout,
+                                   deadline=deadline))
         return True
 
-    def inspect(self, machine="default"):
+    @memoized
+    def inspect(self, machine="default", timeout=None, deadline=None):
         """
         Inspect information about a machine.
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             dict: A nested dicht with inspect information about the machine.
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
+            if self.store is not None:
+                host = self.store.inspect(machine)
+                if host is not None:
+                    return host
             cmd = ["inspect", machine]
-            stdout, _, _ = self._run(cmd)
-            return json.loads(stdout)
+            stdout, _, _ = self._run(cmd, deadline=deadline)
+            with self.metrics.parsing("inspect"):
+                return json.loads(stdout)
 
-    def ip(self, machine="default"):
+    @memoized
+    def ip(self, machine="default", timeout=None, deadline=None):
         """
         Get the IP address of a machine.
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             str: the IP address of a machine.
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
+            ip = self.store.ip(machine) if self.store is not None else None
+            if ip:
+                return ip
             cmd = ["ip", machine]
-            stdout, _, _ = self._run(cmd)
+            stdout, _, _ = self._run(cmd, deadline=deadline)
             return stdout.strip()
 
-    def kill(self, machine="default"):
+    def kill(self, machine="default", timeout=None, deadline=None):
         """
         Kill a machine
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
-            cmd = ["kill", machine]
-            self._run(cmd)
-            return True
+        if self.check_if_exists(machine, deadline=deadline):
+            return self._run_action(["kill"], machine, deadline=deadline)
 
-    def restart(self, machine="default"):
+    def restart(self, machine="default", timeout=None, deadline=None):
         """
         Restart a machine
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
-            cmd = ["restart", machine]
-            self._run(cmd)
-            return True
+        if self.check_if_exists(machine, deadline=deadline):
+            return self._run_action(["restart"], machine, deadline=deadline)
 
-    def upgrade(self, machine="default"):
+    def upgrade(self, machine="default", callback=None, timeout=None, deadline=None):
         """
         Upgrade a machine
 
         Args:
             machine (str): the name of the machine
+            callback (callable): called with (stream, line, timestamp) for every output line
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             bool: True if successful
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
             cmd = ["upgrade", machine]
-            self._run(cmd)
+            try:
+                self._run(cmd, callback=callback, deadline=deadline)
+            finally:
+                self.invalidate_cache(machine)
             return True
 
-    def url(self, machine="default"):
+    @memoized
+    def url(self, machine="default", timeout=None, deadline=None):
         """
         Get the URL of a machine
 
         Args:
             machine (str): the name of the machine
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             str: the URL of a machine
         """
+        deadline = get_deadline(timeout, deadline)
         # be sure machine exists
-        if self.check_if_exists(machine):
+        if self.check_if_exists(machine, deadline=deadline):
+            url = self.store.url(machine) if self.store is not None else None
+            if url:
+                return url
             cmd = ["url", machine]
-            stdout, _, _ = self._run(cmd)
+            stdout, _, _ = self._run(cmd, deadline=deadline)
             return stdout.strip()
 
-    def active(self):
+    def ssh_session(self, machine="default", timeout=None, deadline=None):
+        """
+        Get the multiplexed ssh connection to the machine, shared by every
+        caller. Its address, user, port and key come from inspect.
+
+        Args:
+            machine (str): the name of the machine
+            timeout (float): seconds the inspect call may take
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            SSHSession: the session
+        """
+        with self._sessions_lock:
+            session = self._sessions.get(machine)
+        if session is None:
+            params = ssh_params(self.inspect(machine, timeout=timeout, deadline=deadline))
+            session = SSHSession(ssh=self.ssh_path, idle_timeout=self.ssh_idle_timeout, **params)
+            with self._sessions_lock:
+                session = self._sessions.setdefault(machine, session)
+        return session
+
+    def ssh(self, machine, cmd, input=None, timeout=None, deadline=None):
+        """
+        Run a command on the machine over its multiplexed ssh connection,
+        only the first command pays for the ssh handshake.
+
+        Args:
+            machine (str): the name of the machine
+            cmd (str or List[str]): a shell command line, or arguments quoted for the remote shell
+            input (bytes): sent to the command stdin
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            str: the command stdout
+        """
+        deadline = get_deadline(timeout, deadline)
+        session = self.ssh_session(machine, deadline=deadline)
+        timeout = self._timeout(["ssh"], deadline=deadline)
+        started = self.metrics.started("ssh")
+        returncode, stdout, stderr = None, "", ""
+        try:
+            stdout, stderr, returncode = session.run(cmd, input=input, raise_error=False,
+                                                     timeout=timeout)
+        finally:
+            self.metrics.finished("ssh", started, returncode, len(stdout), len(stderr))
+        if returncode:
+            raise RuntimeError("ssh returned error %s: %s" % (returncode, stderr.strip()))
+        return stdout
+
+    def run_on(self, machines, cmd, concurrency=8, timeout=None, callback=None):
+        """
+        Run a shell command on many machines in parallel over their ssh
+        connections, streaming the output as it comes.
+
+        The existence of the machines is checked once for the whole batch,
+        unknown machines fail with MachineNotFoundError without running anything.
+
+        Args:
+            machines (List[str]): names of the machines
+            cmd (str or List[str]): a shell command line, or arguments quoted for the remote shell
+            concurrency (int): maximum number of commands running at once
+            timeout (float): global deadline in seconds, commands still running are killed
+            callback (callable): called with (machine, stream, line, timestamp) for every line
+        Returns:
+            ParallelStreams: iterate it for (machine, stream, line, timestamp)
+                events, then read its `returncodes` and `errors` per machine
+        """
+        deadline = get_deadline(timeout)
+        self.invalidate_index()
+        names = self._names(deadline)
+
+        def start(machine, timeout):
+            if machine not in names:
+                raise MachineNotFoundError("No machine named %s found" % machine)
+            deadline = get_deadline(timeout)
+            session = self.ssh_session(machine, deadline=deadline)
+            started = self.metrics.started("ssh")
+
+            def on_exit(process):
+                self.metrics.finished("ssh", started, process.returncode, process.bytes[STDOUT],
+                                      process.bytes[STDERR], process.expired)
+
+            try:
+                return session.stream(cmd, timeout=self._timeout(["ssh"], deadline=deadline),
+                                      on_exit=on_exit)
+            except BaseException:
+                self.metrics.finished("ssh", started)
+                raise
+
+        return ParallelStreams(start, machines, concurrency=concurrency,
+                               timeout=get_remaining(deadline), callback=callback)
+
+    def close_ssh(self, machine=None):
+        """
+        Close the ssh connection of machine, or every connection if machine is None.
+        """
+        with self._sessions_lock:
+            if machine is None:
+                sessions = list(self._sessions.values())
+                self._sessions.clear()
+            else:
+                session = self._sessions.pop(machine, None)
+                sessions = [session] if session is not None else []
+        for session in sessions:
+            session.close()
+
+    def active(self, timeout=None, deadline=None):
         """
         Print which machine is active
 
+        Args:
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
         Returns:
             List[str]: a list of machines that are active
         """
         cmd = ["active"]
-        stdout, stderr, error_code = self._run(cmd, raise_error=False)
+        stdout, stderr, error_code = self._run(cmd, raise_error=False, timeout=timeout,
+                                               deadline=deadline)
         if error_code == 1 and stderr.strip() == "No active host found":
             return None
         return stdout.strip()
 
-    def scp(self, source, destination, recursive=False):
+    def scp(self, source, destination, recursive=False, timeout=None, deadline=None):
         """
         Copy files between machines
 
@@ -394,17 +1522,78 @@ class Machine(object):
             source (str): [machine:][path]
             destination (str): [machine:][path]
             recursive (bool):  Copy files recursively (required to copy directories)
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
 
         Returns:
             List[str}: output of the scp command
         """
         r = ["-r"] if recursive else []
         cmd = ["scp"] + r + [source, destination]
-        stdout, _, _ = self._run(cmd)
+        stdout, _, _ = self._run(cmd, timeout=timeout, deadline=deadline)
         return stdout.split()
 
+    def put(self, machine, data, remote_path, chunk_size=CHUNK_SIZE, timeout=None, deadline=None):
+        """
+        Write data to a file of the machine through its ssh connection,
+        in chunks and without a local temporary file.
+
+        Args:
+            machine (str): the name of the machine
+            data: bytes, text, a buffer (bytearray, memoryview, mmap) or a
+                file object open for reading
+            remote_path (str): the file written on the machine
+            chunk_size (int): bytes written at once
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
+        Returns:
+            int: the number of bytes sent
+        """
+        deadline = get_deadline(timeout, deadline)
+        session = self.ssh_session(machine, deadline=deadline)
+        timeout = self._timeout(["ssh"], deadline=deadline)
+        started = self.metrics.started("put")
+        returncode = None
+        try:
+            sent = session.put(data, remote_path, chunk_size=chunk_size, timeout=timeout)
+            returncode = 0
+        finally:
+            self.metrics.finished("put", started, returncode)
+        return sent
+
+    def get(self, machine, remote_path, chunk_size=CHUNK_SIZE, timeout=None, deadline=None):
+        """
+        Read a file of the machine through its ssh connection as it comes.
+
+        Args:
+            machine (str): the name of the machine
+            remote_path (str): the file read on the machine
+            chunk_size (int): bytes read at once
+            timeout (float): seconds the whole transfer may take
+            deadline (float): absolute time.time() the transfer must finish by
+        Returns:
+            io.BufferedReader: binary stream of the file content, close it
+                (or use it as a context manager) to release the connection
+        """
+        deadline = get_deadline(timeout, deadline)
+        session = self.ssh_session(machine, deadline=deadline)
+        timeout = self._timeout(["ssh"], deadline=deadline)
+        started = self.metrics.started("get")
+
+        def on_exit(reader):
+            self.metrics.finished("get", started, reader.returncode, reader.bytes,
+                                  len(reader.stderr), reader.expired)
+
+        try:
+            return session.get(remote_path, chunk_size=chunk_size, timeout=timeout,
+                               on_exit=on_exit)
+        except BaseException:
+            self.metrics.finished("get", started)
+            raise
+
     def create(self, name, driver_name, driver_config={}, engine_opts=[],
-               engine_labels=[], swarm=False, swarm_options={}, verbose=False):
+               engine_labels=[], swarm=False, swarm_options={}, verbose=False,
+               callback=None, timeout=None, deadline=None):
         """
         Create a machine host given a driver configuration.
             inspired by: https://github.com/jgrowl/docker-machine-py/tree/master/docker_machine
@@ -423,56 +1612,118 @@ class Machine(object):
             swarm: (bool): flag for activate swarm
             swarm_options: (dict): options for swarm
             verbose (bool): flag to choose to print every line from docker-machine cli output
+            callback (callable): called with (stream, line, timestamp) for every output line
+            timeout (float): seconds the whole call may take
+            deadline (float): absolute time.time() the call must finish by
 
         Return:
             bool: True if machine successfully created False otherwise
 
         """
+        deadline = get_deadline(timeout, deadline)
 
         # ensure machine doesn't exist yet:
-        if name in self:
+        if name in self._names(deadline):
             raise MachineAlreadyExistsError("Machine %s already exists" % name)
 
-        cmd = ['create']
-        driver_config = create_config_from_dict(driver_name, driver_config)
-
-        # Driver options
-        if driver_config is None:
-            cmd.extend(['--driver', 'none', '--url', 'localhost'])
-        else:
-            cmd.extend(driver_config.args())
-
-        # Engine options
-        if engine_opts:
-            for opt in engine_opts:
-                cmd.append("--engine-opt={}".format(opt))
-
-        # Engine labels
-        if engine_labels:
-            for label in engine_labels:
-                cmd.append("--engine-label={}".format(label))
-
-        # Swarm and swarm options
-        if swarm:
-            cmd.append("--swarm")
-        if swarm_options:
-            swarm_config = SwarmConfig(**swarm_options)
-            cmd.extend(swarm_config.args())
-
-        # Name of the machine
-        cmd.append(name)
+        cmd = self._create_args(driver_name, driver_config, engine_opts,
+                                engine_labels, swarm, swarm_options)
+        return self._create(name, cmd, verbose=verbose, callback=callback, deadline=deadline)
 
+    def _create(self, name, cmd, verbose=False, callback=None, deadline=None):
+        """
+        Run the `create` command cmd for the machine name, remove the
+        machine if creation fails.
+        """
+        cmd = cmd + [name]
+        self.invalidate_cache(name)
         try:
-            stdout, _, _ = self._run(cmd, verbose=verbose)
+            stdout, _, _ = self._run(cmd, verbose=verbose, callback=callback, deadline=deadline)
+            self.invalidate_index()
             return True
-        except RuntimeError, e:
-            print(e)
-            self.rm(machine=name, force=True)
-            raise RuntimeError(e)
-        except KeyboardInterrupt, e:
-            print(e)
-            self.rm(machine=name, force=True)
+        except RuntimeError as e:
+            logger.error("machine %s creation failed: %s" % (name, e))
+            try:
+                self._rollback(name)
+            except Exception as rollback_error:
+                raise RollbackError("creation of %s failed (%s) and removing it failed: %s"
+                                    % (name, e, rollback_error), e, rollback_error)
+            raise
+        except KeyboardInterrupt as e:
+            logger.error("machine %s creation interrupted" % name)
+            self._rollback(name)
             return False
             raise RuntimeError(e)
 
+    def _rollback(self, name):
+        """
+        Remove a machine that failed to be created, if docker-machine got
+        far enough to save it.
+        """
+        self.invalidate_index()
+        if name in self:
+            self.rm(machine=name, force=True)
+
+    def create_many(self, names, driver_name, template={}, overrides={}, concurrency=8,
+                    timeout=None, engine_opts=[], engine_labels=[], swarm=False,
+                    swarm_options={}, verbose=False, callback=None):
+        """
+        Create many machines in parallel from one driver configuration.
+
+        The command is built once from template, only hosts with overrides
+        get their own. A host failing is removed without touching the others.
+
+        Args:
+            names (List[str]): names of the machines, ValueError if one is repeated
+            driver_name (str): one among supported drivers
+            template (dict): driver options shared by every machine
+            overrides (dict): driver options per machine name, merged over template
+            concurrency (int): maximum number of machines created at once
+            timeout (float): global deadline in seconds, hosts still being
+                created by then are killed and rolled back, and the generator
+                ends once their rollback is done. A failed rollback is
+                reported as a RollbackError
+            engine_opts, engine_labels, swarm, swarm_options, verbose: see create
+            callback (callable): called with (name, stream, line, timestamp)
+                for every output line of every host
+        Returns:
+            generator: (name, result, error) tuples as machines are created
+        """
+        names = list(names)
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        if duplicates:
+            # the failing duplicate would roll back, and remove, the machine created once
+            raise ValueError("machine names given more than once: %s" % ", ".join(duplicates))
+
+        def args(driver_config):
+            return self._create_args(driver_name, driver_config, engine_opts,
+                                     engine_labels, swarm, swarm_options)
+
+        cmd = args(template)
+        deadline = get_deadline(timeout)
+        self.invalidate_index()
+        existing = self._names(deadline)
+
+        def create(name):
+            if name in existing:
+                raise MachineAlreadyExistsError("Machine %s already exists" % name)
+            host_cmd = cmd
+            if name in overrides:
+                config = dict(template)
+                config.update(overrides[name])
+                host_cmd = args(config)
+
+            def on_line(stream, line, timestamp):
+                callback(name, stream, line, timestamp)
+
+            result = self._create(name, host_cmd, verbose=verbose,
+                                  callback=on_line if callback is not None else None,
+                                  deadline=deadline)
+            logger.info("machine %s created" % name)
+            return result
+
+        # join: never leave a rollback running in a daemon thread
+        return run_parallel(create, names, concurrency=concurrency,
+                            timeout=get_remaining(deadline), join=True)
+
 
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds of the histogram buckets
+COMMAND_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PARSE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+PREFIX = "docker_machine_"
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of durations, Prometheus style.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            "buckets": dict(zip(self.buckets, self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class Metrics(object):
+    """
+    Counters of the docker-machine commands run by a Machine, keyed by verb
+    (the first argument, `ls`, `start`...): commands run, errors by exit
+    code ("timeout" for killed commands), stdout and stderr bytes, commands
+    in flight and a latency histogram, plus a histogram of the time spent
+    parsing outputs, keyed by parser.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.errors = {}
+            self.stdout_bytes = {}
+            self.stderr_bytes = {}
+            self.in_flight = {}
+            self.durations = {}
+            self.parse_durations = {}
+
+    def started(self, verb):
+        """
+        Record the start of a command.
+
+        Returns:
+            float: the start time to give to finished
+        """
+        with self._lock:
+            self.in_flight[verb] = self.in_flight.get(verb, 0) + 1
+        return time.time()
+
+    def finished(self, verb, started, returncode=None, stdout=0, stderr=0, expired=False):
+        """
+        Record the end of a command.
+
+        Args:
+            verb (str): the docker-machine command
+            started (float): returned by started
+            returncode (int): exit code, None when the command couldn't complete
+            stdout (int): bytes read on stdout
+            stderr (int): bytes read on stderr
+            expired (bool): the command was killed by its timeout
+        """
+        duration = time.time() - started
+        with self._lock:
+            self.in_flight[verb] -= 1
+            self.commands[verb] = self.commands.get(verb, 0) + 1
+            self.stdout_bytes[verb] = self.stdout_bytes.get(verb, 0) + stdout
+            self.stderr_bytes[verb] = self.stderr_bytes.get(verb, 0) + stderr
+            if expired:
+                code = "timeout"
+            elif returncode is None:
+                code = "exception"
+            else:
+                code = str(returncode)
+            if code != "0":
+                key = (verb, code)
+                self.errors[key] = self.errors.get(key, 0) + 1
+            if verb not in self.durations:
+                self.durations[verb] = Histogram(COMMAND_BUCKETS)
+            self.durations[verb].observe(duration)
+
+    @contextmanager
+    def parsing(self, parser):
+        """
+        Time the block as parsing with parser (`ls`, `inspect`...).
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            with self._lock:
+                if parser not in self.parse_durations:
+                    self.parse_durations[parser] = Histogram(PARSE_BUCKETS)
+                self.parse_durations[parser].observe(duration)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: a copy of every metric
+        """
+        with self._lock:
+            return {
+                "commands": dict(self.commands),
+                "errors": dict(self.errors),
+                "stdout_bytes": dict(self.stdout_bytes),
+                "stderr_bytes": dict(self.stderr_bytes),
+                "in_flight": dict(self.in_flight),
+                "durations": dict((k, v.snapshot()) for k, v in self.durations.items()),
+                "parse_durations": dict((k, v.snapshot())
+                                        for k, v in self.parse_durations.items()),
+            }
+
+    def prometheus(self):
+        """
+        Returns:
+            str: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+            for labels, value in sorted(samples):
+                lines.append("%s%s%s %s" % (PREFIX, name, _labels(labels), _value(value)))
+
+        def histogram(name, help, label, histograms):
+            samples = []
+            for key, data in sorted(histograms.items()):
+                for bound in sorted(data["buckets"]):
+                    samples.append((name + "_bucket", ((label, key), ("le", _value(bound))),
+                                    data["buckets"][bound]))
+                samples.append((name + "_bucket", ((label, key), ("le", "+Inf")), data["count"]))
+                samples.append((name + "_sum", ((label, key),), data["sum"]))
+                samples.append((name + "_count", ((label, key),), data["count"]))
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+            for sample, labels, value in samples:
+                lines.append("%s%s%s %s" % (PREFIX, sample, _labels(labels), _value(value)))
+
+        metric("commands_total", "counter", "docker-machine commands run.",
+               [((("verb", k),), v) for k, v in snapshot["commands"].items()])
+        metric("command_errors_total", "counter", "docker-machine commands failed, by exit code.",
+               [((("verb", k[0]), ("code", k[1])), v) for k, v in snapshot["errors"].items()])
+        metric("stdout_bytes_total", "counter", "Bytes read from docker-machine stdout.",
+               [((("verb", k),), v) for k, v in snapshot["stdout_bytes"].items()])
+        metric("stderr_bytes_total", "counter", "Bytes read from docker-machine stderr.",
+               [((("verb", k),), v) for k, v in snapshot["stderr_bytes"].items()])
+        metric("commands_in_flight", "gauge", "docker-machine processes running.",
+               [((("verb", k),), v) for k, v in snapshot["in_flight"].items()])
+        histogram("command_duration_seconds", "docker-machine command latency.",
+                  "verb", snapshot["durations"])
+        histogram("parse_duration_seconds", "Time spent parsing docker-machine outputs.",
+                  "parser", snapshot["parse_durations"])
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
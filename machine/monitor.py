@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import namedtuple
+
+from .records import State
+
+logger = logging.getLogger("machine")
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+
+# states a machine only goes through, poll fast while one is seen
+TRANSIENT_STATES = (State.STARTING, State.STOPPING)
+
+
+class FleetEvent(namedtuple("FleetEvent", ["kind", "name", "old", "new"])):
+    """
+    A change seen by FleetMonitor or StoreWatcher: `kind` is ADDED, REMOVED
+    or CHANGED, `old` and `new` the MachineRecord (monitor) or config dict
+    (watcher) before and after, None when absent.
+    """
+    __slots__ = ()
+
+
+class FleetMonitor(object):
+    """
+    Keep the state of every machine up to date from a background thread.
+
+    The fleet is listed with Machine.iter_ls every `fast_interval` seconds
+    while machines are changing or starting/stopping, and the interval
+    doubles up to `slow_interval` while nothing changes. Once attached to a
+    Machine (see Machine.monitor), its status, status_many, exists and
+    `in` are answered from the last listing without running docker-machine.
+    """
+    def __init__(self, machine, fast_interval=1, slow_interval=30, timeout=10):
+        """
+        Args:
+            machine (Machine): used to list the machines
+            fast_interval (float): seconds between listings while the fleet changes
+            slow_interval (float): maximum seconds between listings
+            timeout (int): seconds docker-machine waits for each daemon
+        """
+        self.machine = machine
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.timeout = timeout
+        self.interval = fast_interval
+        self._records = None
+        self._names = None
+        # the last listing is served only while fresh, see invalidate
+        self._fresh = False
+        self._generation = 0
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: MachineRecord by machine name from the last listing,
+                None before the first listing or after invalidate
+        """
+        return self._records if self._fresh else None
+
+    def names(self):
+        """
+        Returns:
+            frozenset: machine names from the last listing, None before
+                the first listing or after invalidate
+        """
+        return self._names if self._fresh else None
+
+    def subscribe(self, callback):
+        """
+        Call callback(FleetEvent) from the monitor thread for every change.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def poke(self):
+        """
+        Refresh now and poll fast again, the fleet is about to change.
+        """
+        self.interval = self.fast_interval
+        self._wake.set()
+
+    def invalidate(self):
+        """
+        Stop serving the last listing until a listing started after this
+        call completes, and refresh now: the fleet was just changed.
+        """
+        with self._lock:
+            self._generation += 1
+            self._fresh = False
+        self.poke()
+
+    def refresh(self):
+        """
+        List the machines once and publish the changes.
+
+        Returns:
+            List[FleetEvent]: the changes
+        """
+        generation = self._generation
+        records = dict((x.name, x) for x in self.machine.iter_ls(timeout=self.timeout))
+        old = self._records or {}
+        events = []
+        if self._records is not None:
+            for name, record in records.items():
+                if name not in old:
+                    events.append(FleetEvent(ADDED, name, None, record))
+                elif old[name].state != record.state:
+                    events.append(FleetEvent(CHANGED, name, old[name], record))
+            for name in old:
+                if name not in records:
+                    events.append(FleetEvent(REMOVED, name, old[name], None))
+        with self._lock:
+            self._records = records
+            self._names = frozenset(records)
+            # a listing started before an invalidation may miss the change
+            self._fresh = generation == self._generation
+
+        if events or any(x.state in TRANSIENT_STATES for x in records.values()):
+            self.interval = self.fast_interval
+        else:
+            self.interval = min(self.interval * 2, self.slow_interval)
+
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for event in events:
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception("fleet monitor callback failed")
+        return events
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning("fleet monitor listing failed: %s" % e)
+                self.interval = self.fast_interval
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        """
+        Start polling in a daemon thread.
+        """
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="machine-fleet-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stop polling and wait for the thread to exit.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import sys
+import threading
+import time
+from subprocess import Popen, PIPE
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .errors import CommandTimeoutError
+
+STDOUT = "stdout"
+STDERR = "stderr"
+
+
+def popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE):
+    """
+    Start cmd, with piped stdin, stdout and stderr by default, in its own
+    process group so it can be killed along with the children it spawns
+    (ssh, drivers).
+    """
+    if os.name == "posix":
+        # close_fds: pipes of concurrent calls must not leak into this child,
+        # or communicate() waits for the other children to exit (python 2)
+        if sys.version_info >= (3, 2):
+            return Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                         close_fds=True, start_new_session=True)
+        # python 2: preexec_fn may deadlock the child when other threads run,
+        # there is no other way to get a new session
+        return Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                     close_fds=True, preexec_fn=os.setsid)
+    return Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+
+
+def kill_group(process):
+    """
+    Kill process and its process group.
+
+    Returns:
+        bool: True if the kill was sent, False if the process had already exited
+    """
+    if process.poll() is not None:
+        return False
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        return False
+    return True
+
+
+class Watchdog(object):
+    """
+    Kill the process group of a process when timeout expires, use as a
+    context manager around the wait for the process.
+    """
+    def __init__(self, process, timeout):
+        """
+        Args:
+            process (Popen): the process to watch
+            timeout (float): seconds before killing it, None to never kill it
+        """
+        self.process = process
+        self.timeout = timeout
+        self.expired = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        with self._lock:
+            # a command exiting as the timer fires did not time out
+            self.expired = kill_group(self.process)
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self._timer = threading.Timer(self.timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._timer is not None:
+            self._timer.cancel()
+            # wait for a kill in progress, expired is final after this
+            with self._lock:
+                pass
+        if exc[0] is not None:
+            # interrupted: don't leave the child behind
+            kill_group(self.process)
+
+
+class StreamingProcess(object):
+    """
+    Run a command and stream its output line by line.
+
+    stdout and stderr are drained by one thread each so a chatty stream can
+    never fill its pipe and block the child. Iterating yields
+    (stream, line, timestamp) events, `stream` being STDOUT or STDERR and
+    `line` a str without its trailing newline. At most `max_pending` lines
+    are held in memory: the readers wait for the consumer beyond that.
+    The process group is killed after `timeout` seconds, `expired` tells
+    if it happened, or as soon as the iteration stops early. `bytes` counts the bytes read on each stream.
+    """
+    def __init__(self, cmd, callback=None, max_pending=1024, timeout=None, on_exit=None):
+        """
+        Args:
+            cmd (List[str]): the command to run
+            callback (callable): called with (stream, line, timestamp) for every line
+            max_pending (int): lines buffered before the readers wait
+            timeout (float): seconds before the process is killed
+            on_exit (callable): called with this StreamingProcess once the
+                iteration ends, returncode is None if it was stopped early
+        """
+        self.cmd = cmd
+        self.callback = callback
+        self.on_exit = on_exit
+        self.returncode = None
+        self.bytes = {STDOUT: 0, STDERR: 0}
+        self.process = popen(cmd)
+        self.process.stdin.close()
+        self._events = queue.Queue(maxsize=max_pending)
+        self._readers = [self._reader(STDOUT, self.process.stdout),
+                         self._reader(STDERR, self.process.stderr)]
+        self._opened = len(self._readers)
+        self._watchdog = Watchdog(self.process, timeout).__enter__()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def _reader(self, stream, pipe):
+        def read():
+            try:
+                for line in iter(pipe.readline, b""):
+                    self.bytes[stream] += len(line)
+                    line = line.decode("utf-8", "replace").rstrip("\r\n")
+                    self._events.put((stream, line, time.time()))
+            finally:
+                pipe.close()
+                self._events.put((stream, None, time.time()))
+
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __iter__(self):
+        try:
+            while self._opened:
+                try:
+                    # a finite wait keeps ctrl-c working on python 2
+                    event = self._events.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if event[1] is None:
+                    self._opened -= 1
+                    continue
+                if self.callback is not None:
+                    self.callback(*event)
+                yield event
+            self.returncode = self.process.wait()
+        finally:
+            if self.returncode is None:
+                # stopped early: don't leave the child, nor the timer, behind
+                kill_group(self.process)
+                self.process.wait()
+            self._watchdog.__exit__(None, None, None)
+            on_exit, self.on_exit = self.on_exit, None
+            if on_exit is not None:
+                on_exit(self)
+
+    @property
+    def expired(self):
+        return self._watchdog.expired
+
+    def wait(self):
+        """
+        Consume all the output and wait for the process.
+
+        Returns:
+            int: the exit code
+        """
+        for _ in self:
+            pass
+        return self.returncode
+
+    def kill(self):
+        kill_group(self.process)
+
+
+class ParallelStreams(object):
+    """
+    Run a streaming command per item on a bounded pool of threads and merge
+    their output.
+
+    Iterating yields (item, stream, line, timestamp) events as the lines
+    arrive from any process. Once the iteration ends `returncodes` maps
+    every item whose process exited to its exit code, and `errors` maps
+    the other items to the exception that stopped them: failure to start,
+    or CommandTimeoutError when the global timeout killed the process or
+    expired before it started. Stopping the iteration early kills the
+    running processes and drops the items not started yet.
+    """
+    def __init__(self, start, items, concurrency=8, timeout=None, callback=None,
+                 max_pending=1024):
+        """
+        Args:
+            start (callable): called with (item, timeout) in a worker thread,
+                returns the StreamingProcess of the item, timeout being the
+                seconds left before the global deadline (None if there is none)
+            items (iterable): the items
+            concurrency (int): maximum number of processes running at once
+            timeout (float): global deadline in seconds
+            callback (callable): called with (item, stream, line, timestamp) for every line
+            max_pending (int): lines buffered before the processes wait
+        """
+        self.items = list(items)
+        self.timeout = timeout
+        self.callback = callback
+        self.returncodes = {}
+        self.errors = {}
+        self._start = start
+        self._deadline = time.time() + timeout if timeout is not None else None
+        self._events = queue.Queue(maxsize=max_pending)
+        self._tasks = queue.Queue()
+        for item in self.items:
+            self._tasks.put(item)
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        for _ in range(min(concurrency, len(self.items))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, event):
+        while not self._stop.is_set():
+            try:
+                self._events.put(event, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                item = self._tasks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self._run(item)
+            except Exception as e:
+                self.errors[item] = e
+            # None stream: the item is done
+            self._put((item, None, None, time.time()))
+
+    def _run(self, item):
+        timeout = None
+        if self._deadline is not None:
+            timeout = self._deadline - time.time()
+            if timeout <= 0:
+                raise CommandTimeoutError("deadline of %.1fs exceeded before starting" % self.timeout)
+        process = self._start(item, timeout)
+        with self._lock:
+            self._running[item] = process
+        events = iter(process)
+        try:
+            for stream, line, timestamp in events:
+                if not self._put((item, stream, line, timestamp)):
+                    process.kill()
+                    return
+        finally:
+            events.close()
+            with self._lock:
+                self._running.pop(item, None)
+        if process.expired:
+            raise CommandTimeoutError("deadline of %.1fs exceeded" % self.timeout)
+        self.returncodes[item] = process.returncode
+
+    def __iter__(self):
+        done = 0
+        try:
+            while done < len(self.items):
+                try:
+                    # a finite wait keeps ctrl-c working on python 2
+                    event = self._events.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if event[1] is None:
+                    done += 1
+                    continue
+                if self.callback is not None:
+                    self.callback(*event)
+                yield event
+        finally:
+            self.kill()
+
+    def wait(self):
+        """
+        Consume all the output and wait for the processes.
+
+        Returns:
+            tuple: returncodes and errors, see the class
+        """
+        for _ in self:
+            pass
+        return self.returncodes, self.errors
+
+    def kill(self):
+        """
+        Kill the running processes and drop the items not started yet.
+        """
+        self._stop.set()
+        with self._lock:
+            running = list(self._running.values())
+        for process in running:
+            process.kill()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import namedtuple
+
+try:
+    from enum import Enum
+except ImportError:
+    # python 2 without enum34: members are plain strings
+    Enum = object
+
+
+class State(str, Enum):
+    """
+    State of a machine as reported by docker-machine, members compare
+    equal to their string value.
+    """
+    NONE = ""
+    RUNNING = "Running"
+    PAUSED = "Paused"
+    SAVED = "Saved"
+    STOPPED = "Stopped"
+    STOPPING = "Stopping"
+    STARTING = "Starting"
+    ERROR = "Error"
+    TIMEOUT = "Timeout"
+    UNKNOWN = "Unknown"
+
+
+def parse_state(value):
+    """
+    Args:
+        value (str): state printed by docker-machine
+    Returns:
+        State: the state, State.UNKNOWN if value isn't a known state
+    """
+    try:
+        return State(value)
+    except ValueError:
+        return State.UNKNOWN
+
+
+class MachineRecord(namedtuple("MachineRecord", [
+        "name", "active", "active_host", "active_swarm", "driver_name", "state",
+        "url", "swarm", "error", "docker_version", "response_time"])):
+    """
+    A row of `docker-machine ls`, `state` is a State, `response_time` the
+    daemon response time in milliseconds (None if unknown) and `active`,
+    `active_host`, `active_swarm` are booleans.
+    """
+    __slots__ = ()
+
+
+DURATION_UNITS = {
+    "ns": 1e-6,
+    "us": 1e-3,
+    u"µs": 1e-3,
+    "ms": 1.0,
+    "s": 1e3,
+    "m": 60e3,
+    "h": 3600e3,
+}
+DURATION_REGEXP = re.compile(u"([0-9]*\\.?[0-9]+)(ns|us|µs|ms|s|m|h)")
+
+
+def parse_duration(value):
+    """
+    Parse a go duration (`1.5s`, `320.2ms`, `1m2s`).
+
+    Args:
+        value (str): the duration
+    Returns:
+        float: the duration in milliseconds, None if value isn't a duration
+    """
+    value = value.strip()
+    if not value:
+        return None
+    total, end = 0.0, 0
+    for match in DURATION_REGEXP.finditer(value):
+        if match.start() != end:
+            return None
+        total += float(match.group(1)) * DURATION_UNITS[match.group(2)]
+        end = match.end()
+    if end != len(value):
+        try:
+            # bare number, "0" for instance
+            return float(value)
+        except ValueError:
+            return None
+    return total
+
+
+def parse_ls_row(values):
+    """
+    Build a MachineRecord from the values of an `ls` row, in LS_FIELDS order.
+
+    Returns:
+        MachineRecord: the record or None for an empty row
+    """
+    values = list(values) + [""] * (len(MachineRecord._fields) - len(values))
+    name, active, active_host, active_swarm, driver_name, state, url, swarm, error, \
+        docker_version, response_time = values[:len(MachineRecord._fields)]
+    if not name:
+        return None
+    return MachineRecord(
+        name=name,
+        active=active.strip() == "*",
+        active_host=active_host.strip() == "true",
+        active_swarm=active_swarm.strip() == "true",
+        driver_name=driver_name,
+        state=parse_state(state),
+        url=url,
+        swarm=swarm,
+        error=error,
+        docker_version=docker_version,
+        response_time=parse_duration(response_time))
+
+
+# lines of `docker-machine env` setting a variable, for each --shell
+ENV_REGEXPS = [
+    re.compile(r'^export (\w+)="(.*)"$'),            # bash, sh, zsh
+    re.compile(r'^set -gx (\w+) "(.*)";$'),          # fish
+    re.compile(r'^setenv (\w+) "(.*)";?$'),          # tcsh
+    re.compile(r'^\$Env:(\w+) = "(.*)"$'),          # powershell
+    re.compile(r'^SET (\w+)=(.*)$'),                 # cmd
+    re.compile(r'^\(setenv "(\w+)" "(.*)"\)$'),      # emacs
+]
+
+
+def parse_env(stdout):
+    """
+    Parse the output of `docker-machine env`, whatever the shell it targets.
+
+    Returns:
+        dict: value by variable name
+    """
+    variables = {}
+    for line in stdout.splitlines():
+        line = line.strip()
+        for regexp in ENV_REGEXPS:
+            match = regexp.match(line)
+            if match:
+                variables[match.group(1)] = match.group(2)
+                break
+    return variables
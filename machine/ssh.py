@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    # python 2
+    from pipes import quote
+
+from .process import popen, kill_group, StreamingProcess, Watchdog
+from .errors import CommandTimeoutError
+
+# options docker-machine itself gives to ssh
+SSH_OPTIONS = [
+    "-F", "/dev/null",
+    "-o", "ConnectionAttempts=3",
+    "-o", "ConnectTimeout=10",
+    "-o", "LogLevel=quiet",
+    "-o", "PasswordAuthentication=no",
+    "-o", "ServerAliveInterval=60",
+    "-o", "StrictHostKeyChecking=no",
+    "-o", "UserKnownHostsFile=/dev/null",
+    "-o", "IdentitiesOnly=yes",
+]
+
+# bytes read or written at once by put and get
+CHUNK_SIZE = 64 * 1024
+
+
+def ssh_params(host):
+    """
+    Get the ssh connection parameters of a machine from its inspect output.
+
+    Args:
+        host (dict): the output of Machine.inspect
+    Returns:
+        dict: address, user, port and key (None when the driver has no key)
+    """
+    driver = host.get("Driver") or {}
+    address = driver.get("IPAddress")
+    if not address:
+        raise RuntimeError("machine %s has no IP address" % host.get("Name"))
+    return {
+        "address": address,
+        "user": driver.get("SSHUser") or "docker",
+        "port": int(driver.get("SSHPort") or 22),
+        "key": driver.get("SSHKeyPath") or None,
+    }
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """
+    Split data in chunks of at most chunk_size bytes without copying it
+    whole.
+
+    Args:
+        data: bytes, text (utf-8 encoded), any buffer (bytearray,
+            memoryview, mmap) or a file object open for reading
+        chunk_size (int): maximum size of a chunk
+    Returns:
+        generator: the chunks, memoryviews over data when it is a buffer
+    """
+    if isinstance(data, type(u"")):
+        data = data.encode("utf-8")
+    try:
+        view = memoryview(data)
+    except TypeError:
+        if isinstance(data, mmap.mmap):
+            # python 2 mmap, slicing copies a chunk at a time
+            view = data
+        else:
+            for chunk in iter(lambda: data.read(chunk_size), data.read(0)):
+                yield chunk.encode("utf-8") if isinstance(chunk, type(u"")) else chunk
+            return
+    else:
+        if view.itemsize != 1 and hasattr(view, "cast"):
+            view = view.cast("B")
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+
+class RemoteReader(io.RawIOBase):
+    """
+    Raw stream over the stdout of a remote command, see SSHSession.get.
+
+    Reaching the end raises RuntimeError if the command failed, and
+    CommandTimeoutError if it was killed by its timeout. Closing the
+    stream before the end kills the command.
+    """
+    def __init__(self, process, timeout=None, on_exit=None):
+        """
+        Args:
+            process (Popen): the ssh process
+            timeout (float): seconds before the process is killed
+            on_exit (callable): called with this RemoteReader once the
+                process ended, returncode is None if it was killed by close
+        """
+        super(RemoteReader, self).__init__()
+        self.process = process
+        self.on_exit = on_exit
+        self.returncode = None
+        self.bytes = 0
+        self.stderr = b""
+        self._exited = False
+        process.stdin.close()
+        self._watchdog = Watchdog(process, timeout).__enter__()
+        self._stderr_reader = threading.Thread(target=self._read_stderr)
+        self._stderr_reader.daemon = True
+        self._stderr_reader.start()
+
+    def _read_stderr(self):
+        self.stderr = self.process.stderr.read()
+
+    @property
+    def expired(self):
+        return self._watchdog.expired
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = os.read(self.process.stdout.fileno(), len(b))
+        if data:
+            b[:len(data)] = data
+            self.bytes += len(data)
+            return len(data)
+        self._exit(self.process.wait())
+        if self.expired:
+            raise CommandTimeoutError("ssh transfer timed out after %.1fs" % self._watchdog.timeout)
+        if self.returncode:
+            raise RuntimeError("ssh returned error %s: %s"
+                               % (self.returncode, self.stderr.decode("utf-8", "replace").strip()))
+        return 0
+
+    def _exit(self, returncode):
+        self._exited = True
+        self._watchdog.__exit__(None, None, None)
+        self._stderr_reader.join()
+        self.returncode = returncode
+        on_exit, self.on_exit = self.on_exit, None
+        if on_exit is not None:
+            on_exit(self)
+
+    def close(self):
+        if not self.closed:
+            if not self._exited:
+                # stopped before the end
+                kill_group(self.process)
+                self.process.wait()
+                self._exit(None)
+            self.process.stdout.close()
+            self.process.stderr.close()
+        super(RemoteReader, self).close()
+
+
+class SSHSession(object):
+    """
+    Run commands on a machine over a single multiplexed ssh connection.
+
+    The first command starts a background master connection (ssh
+    ControlMaster), the next ones go through it without a new handshake.
+    The master exits after `idle_timeout` seconds without commands and is
+    started again when needed; close() stops it right away.
+    """
+    def __init__(self, address, user="docker", port=22, key=None, ssh="ssh",
+                 idle_timeout=300, timeout=None):
+        """
+        Args:
+            address (str): IP address or host name of the machine
+            user (str): ssh user
+            port (int): ssh port
+            key (str): path of the private key
+            ssh (str): path of the ssh client
+            idle_timeout (int): seconds the master connection outlives its last command
+            timeout (float): default timeout of the commands in seconds
+        """
+        self.address = address
+        self.user = user
+        self.port = port
+        self.key = key
+        self.ssh = ssh
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._directory = None
+        self._lock = threading.Lock()
+
+    @property
+    def control_path(self):
+        if self._directory is None:
+            # unix socket paths are short, keep this one under the limit
+            self._directory = tempfile.mkdtemp(prefix="machine-ssh-")
+        name = hashlib.sha1(("%s@%s:%s" % (self.user, self.address, self.port))
+                            .encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self._directory, name)
+
+    def args(self, *extra):
+        """
+        Returns:
+            List[str]: the ssh command up to the destination, extra options
+                inserted before it
+        """
+        args = [self.ssh] + SSH_OPTIONS + ["-o", "ControlPath=%s" % self.control_path,
+                                           "-p", str(self.port)]
+        if self.key:
+            args += ["-i", self.key]
+        return args + list(extra) + ["%s@%s" % (self.user, self.address)]
+
+    def connect(self, timeout=None):
+        """
+        Start the master connection unless it is running.
+        """
+        with self._lock:
+            if os.path.exists(self.control_path):
+                return
+            cmd = self.args("-o", "ControlMaster=yes",
+                            "-o", "ControlPersist=%d" % self.idle_timeout, "-N", "-f")
+            with open(os.devnull, "r+b") as devnull:
+                # -f: ssh goes to the background once authenticated, it must
+                # not hold our pipes open
+                p = popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull)
+                with Watchdog(p, timeout) as watchdog:
+                    returncode = p.wait()
+            if watchdog.expired:
+                raise CommandTimeoutError("ssh connection to %s timed out after %.1fs"
+                                          % (self.address, timeout))
+            if returncode:
+                raise RuntimeError("ssh connection to %s failed with error %s"
+                                   % (self.address, returncode))
+
+    def command(self, cmd):
+        """
+        Returns:
+            List[str]: the ssh command running cmd through the master connection
+        """
+        if not isinstance(cmd, (str, type(u""))):
+            cmd = " ".join(quote(x) for x in cmd)
+        return self.args("-o", "ControlMaster=no") + [cmd]
+
+    def popen(self, cmd, timeout=None):
+        """
+        Start cmd on the machine, connecting first if needed.
+
+        Args:
+            cmd (str or List[str]): a shell command line, or arguments quoted for the remote shell
+            timeout (float): seconds the connection may take
+        Returns:
+            Popen: the ssh process with piped stdin, stdout and stderr
+        """
+        self.connect(timeout=timeout if timeout is not None else self.timeout)
+        return popen(self.command(cmd))
+
+    def stream(self, cmd, callback=None, timeout=None, on_exit=None):
+        """
+        Start cmd on the machine and stream its output, connecting first if needed.
+
+        Args:
+            cmd (str or List[str]): a shell command line, or arguments quoted for the remote shell
+            callback (callable): called with (stream, line, timestamp) for every line
+            timeout (float): seconds before the command is killed, connection included
+            on_exit (callable): see StreamingProcess
+        Returns:
+            StreamingProcess: the ssh process
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.time() + timeout if timeout is not None else None
+        self.connect(timeout=timeout)
+        remaining = max(deadline - time.time(), 0) if deadline is not None else None
+        return StreamingProcess(self.command(cmd), callback=callback, timeout=remaining,
+                                on_exit=on_exit)
+
+    def run(self, cmd, input=None, raise_error=True, timeout=None):
+        """
+        Run cmd on the machine.
+
+        Args:
+            cmd (str or List[str]): a shell command line, or arguments quoted for the remote shell
+            input (bytes): sent to the command stdin
+            raise_error (bool): raise an exception on non 0 return code
+            timeout (float): seconds before the command is killed
+        Returns:
+            tuple: stdout, stderr, error_code
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.time() + timeout if timeout is not None else None
+        p = self.popen(cmd, timeout=timeout)
+        remaining = max(deadline - time.time(), 0) if deadline is not None else None
+        with Watchdog(p, remaining) as watchdog:
+            stdout, stderr = p.communicate(input)
+        stdout, stderr = stdout.decode("utf-8"), stderr.decode("utf-8")
+        if watchdog.expired:
+            raise CommandTimeoutError("ssh %s timed out after %.1fs" % (cmd, timeout))
+        if raise_error and p.returncode:
+            raise RuntimeError("ssh returned error %s: %s" % (p.returncode, stderr.strip()))
+        return stdout, stderr, p.returncode
+
+    def put(self, data, remote_path, chunk_size=CHUNK_SIZE, timeout=None):
+        """
+        Write data to a file of the machine, streamed through the ssh
+        connection chunk by chunk, so it is never held whole in memory
+        nor written to a local temporary file.
+
+        Args:
+            data: bytes, text, a buffer (bytearray, memoryview, mmap) or a
+                file object open for reading, see iter_chunks
+            remote_path (str): the file written on the machine
+            chunk_size (int): bytes written at once
+            timeout (float): seconds before the transfer is killed
+        Returns:
+            int: the number of bytes sent
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.time() + timeout if timeout is not None else None
+        p = self.popen("cat > %s" % quote(remote_path), timeout=timeout)
+        remaining = max(deadline - time.time(), 0) if deadline is not None else None
+        sent = 0
+        with Watchdog(p, remaining) as watchdog:
+            try:
+                for chunk in iter_chunks(data, chunk_size):
+                    p.stdin.write(chunk)
+                    sent += len(chunk)
+                p.stdin.close()
+            except (IOError, OSError) as e:
+                # EPIPE: the remote command exited early, its stderr tells why
+                if e.errno != errno.EPIPE:
+                    raise
+            p.stdout.read()
+            stderr = p.stderr.read().decode("utf-8", "replace")
+            p.wait()
+        if watchdog.expired:
+            raise CommandTimeoutError("ssh transfer to %s timed out after %.1fs"
+                                      % (remote_path, timeout))
+        if p.returncode:
+            raise RuntimeError("ssh returned error %s: %s" % (p.returncode, stderr.strip()))
+        return sent
+
+    def get(self, remote_path, chunk_size=CHUNK_SIZE, timeout=None, on_exit=None):
+        """
+        Read a file of the machine as it comes through the ssh connection.
+
+        Args:
+            remote_path (str): the file read on the machine
+            chunk_size (int): bytes read at once
+            timeout (float): seconds before the transfer is killed
+            on_exit (callable): see RemoteReader
+        Returns:
+            io.BufferedReader: binary stream of the file content, close it
+                (or use it as a context manager) to release the connection
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        deadline = time.time() + timeout if timeout is not None else None
+        p = self.popen("cat %s" % quote(remote_path), timeout=timeout)
+        remaining = max(deadline - time.time(), 0) if deadline is not None else None
+        return io.BufferedReader(RemoteReader(p, remaining, on_exit=on_exit),
+                                 buffer_size=chunk_size)
+
+    def close(self):
+        """
+        Stop the master connection.
+        """
+        with self._lock:
+            if self._directory is None:
+                return
+            if os.path.exists(self.control_path):
+                with open(os.devnull, "r+b") as devnull:
+                    subprocess.call(self.args("-O", "exit"), stdin=devnull, stdout=devnull,
+                                    stderr=devnull, close_fds=os.name == "posix")
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
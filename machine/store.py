@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import copy
+import json
+import os
+import threading
+
+from .helper import storage_path
+
+# docker engine port used by docker-machine drivers
+DEFAULT_ENGINE_PORT = 2376
+
+
+class FileStore(object):
+    """
+    Read machines straight from the docker-machine storage directory
+    (``<storage>/machines/<name>/config.json``) instead of spawning the
+    docker-machine binary.
+
+    Every file is parsed once and only read again when its mtime changes.
+    Methods return None when the store can't answer, so the caller can fall
+    back to docker-machine.
+    """
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str): storage directory, defaults to MACHINE_STORAGE_PATH
+                or ~/.docker/machine
+        """
+        self.path = path
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def storage_path(self):
+        """
+        Returns:
+            str: absolute path of the storage directory
+        """
+        if self.path:
+            return os.path.abspath(os.path.expanduser(self.path))
+        return storage_path()
+
+    def machine_path(self, machine):
+        """
+        Returns:
+            str: the directory holding the files of the machine
+        """
+        return os.path.join(self.storage_path(), "machines", machine)
+
+    def _cached(self, path, load):
+        """
+        Return load(path), cached until the mtime of path changes.
+        None if path doesn't exist or can't be loaded.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            with self._lock:
+                self._cache.pop(path, None)
+            return None
+        with self._lock:
+            entry = self._cache.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        try:
+            value = load(path)
+        except (IOError, OSError, ValueError):
+            return None
+        with self._lock:
+            self._cache[path] = (mtime, value)
+        return value
+
+    def clear(self):
+        """
+        Forget every cached file.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def names(self):
+        """
+        Returns:
+            frozenset: names of the machines in the store
+        """
+        def load(path):
+            return frozenset(name for name in os.listdir(path)
+                             if os.path.isdir(os.path.join(path, name)))
+
+        names = self._cached(os.path.join(self.storage_path(), "machines"), load)
+        return names or frozenset()
+
+    def exists(self, machine):
+        return machine in self.names()
+
+    def inspect(self, machine):
+        """
+        Same data as `docker-machine inspect`.
+
+        Returns:
+            dict: the machine config.json or None, a copy the caller may modify
+        """
+        host = self._host(machine)
+        return copy.deepcopy(host) if host is not None else None
+
+    def _host(self, machine):
+        """ the cached config.json of machine, not to be modified """
+        def load(path):
+            with open(path) as f:
+                return json.load(f)
+
+        return self._cached(os.path.join(self.machine_path(machine), "config.json"), load)
+
+    def ip(self, machine):
+        """
+        Returns:
+            str: last IP address saved by the driver or None
+        """
+        host = self._host(machine)
+        if not host:
+            return None
+        return (host.get("Driver") or {}).get("IPAddress") or None
+
+    def url(self, machine):
+        """
+        Returns:
+            str: the docker daemon URL or None
+        """
+        host = self._host(machine)
+        if not host:
+            return None
+        driver = host.get("Driver") or {}
+        if host.get("DriverName") == "none":
+            return driver.get("URL") or None
+        ip = driver.get("IPAddress")
+        if not ip:
+            return None
+        return "tcp://%s:%s" % (ip, driver.get("EnginePort") or DEFAULT_ENGINE_PORT)
+
+    def config(self, machine):
+        """
+        Same data as `docker-machine config`.
+
+        Returns:
+            dict: tlscacert, tlscert, tlskey, host or None
+        """
+        host = self._host(machine)
+        url = self.url(machine)
+        if not host or not url:
+            return None
+        auth = (host.get("HostOptions") or {}).get("AuthOptions") or {}
+        config = {
+            "tlscacert": auth.get("CaCertPath"),
+            "tlscert": auth.get("ClientCertPath"),
+            "tlskey": auth.get("ClientKeyPath"),
+            "host": url
+        }
+        if not all(config.values()):
+            return None
+        return config
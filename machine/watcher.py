@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+from .monitor import FleetEvent, ADDED, REMOVED, CHANGED
+from .store import FileStore
+
+logger = logging.getLogger("machine")
+
+# inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+MACHINES_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+MACHINE_MASK = IN_CLOSE_WRITE | IN_MODIFY | IN_ATTRIB | IN_CREATE | IN_DELETE | \
+    IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# files of a machine whose change matters
+WATCHED_FILES = ("config.json", "ca.pem", "cert.pem", "key.pem", "server.pem")
+
+
+def _libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class StoreWatcher(object):
+    """
+    Keep an index of the machines of the storage directory, updated as
+    their files change.
+
+    On Linux the directory is watched with inotify, elsewhere (or when
+    inotify can't be used) the files are polled every `interval` seconds.
+    Either way only the machines whose files changed are read again.
+    `callback` gets a FleetEvent for every machine added, removed or
+    changed, `old` and `new` being the machine config.json as dicts.
+    """
+    def __init__(self, store=None, callback=None, interval=2, use_inotify=True):
+        """
+        Args:
+            store (FileStore): store to read the machines from
+            callback (callable): called with a FleetEvent for every change
+            interval (float): seconds between scans when polling
+            use_inotify (bool): False to always poll
+        """
+        self.store = store or FileStore()
+        self.callback = callback
+        self.interval = interval
+        self.use_inotify = use_inotify
+        self.machines = {}
+        self._stamps = {}
+        self._names = frozenset()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def names(self):
+        """
+        Returns:
+            frozenset: names of the machines
+        """
+        return self._names
+
+    def get(self, machine):
+        """
+        Returns:
+            dict: config.json of the machine, None if it doesn't exist
+        """
+        return self.machines.get(machine)
+
+    def _stamp(self, machine):
+        path = self.store.machine_path(machine)
+        stamp = []
+        for name in WATCHED_FILES:
+            try:
+                stamp.append(os.stat(os.path.join(path, name)).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _update(self, machines):
+        """
+        Read the given machines again and publish what changed.
+        """
+        with self._lock:
+            events = self._diff(machines)
+        if self.callback is not None:
+            for event in events:
+                try:
+                    self.callback(event)
+                except Exception:
+                    logger.exception("storage watcher callback failed")
+        return events
+
+    def _diff(self, machines):
+        names = self.store.names()
+        events = []
+        for machine in machines:
+            old = self.machines.get(machine)
+            if machine not in names:
+                if machine in self.machines:
+                    del self.machines[machine]
+                    self._stamps.pop(machine, None)
+                    events.append(FleetEvent(REMOVED, machine, old, None))
+                continue
+            stamp = self._stamp(machine)
+            if machine in self.machines and stamp == self._stamps.get(machine):
+                continue
+            self._stamps[machine] = stamp
+            new = self.store.inspect(machine) or {}
+            self.machines[machine] = new
+            events.append(FleetEvent(CHANGED if old is not None else ADDED, machine, old, new))
+        self._names = frozenset(self.machines)
+        return events
+
+    def scan(self):
+        """
+        Check every machine, the polling step.
+
+        Returns:
+            List[FleetEvent]: the changes
+        """
+        return self._update(set(self.store.names()) | set(self.machines))
+
+    def start(self):
+        """
+        Scan once then watch in a daemon thread.
+        """
+        if self._thread is not None:
+            return self
+        self.scan()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="machine-store-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self):
+        libc = _libc() if self.use_inotify else None
+        if libc is not None:
+            try:
+                self._watch(libc)
+                return
+            except OSError as e:
+                logger.warning("inotify unavailable, polling the storage directory: %s" % e)
+        while not self._stop.wait(self.interval):
+            try:
+                self.scan()
+            except Exception as e:
+                logger.warning("storage directory scan failed: %s" % e)
+
+    def _add_watch(self, libc, fd, path, mask):
+        wd = libc.inotify_add_watch(fd, path.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def _watch(self, libc):
+        machines_path = os.path.join(self.store.storage_path(), "machines")
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        try:
+            root = self._add_watch(libc, fd, machines_path, MACHINES_MASK)
+            watches = {}
+
+            def watch_machine(machine):
+                try:
+                    wd = self._add_watch(libc, fd, os.path.join(machines_path, machine), MACHINE_MASK)
+                    watches[wd] = machine
+                except OSError:
+                    pass
+
+            for machine in self.store.names():
+                watch_machine(machine)
+            # machines created between the first scan and the watches
+            self.scan()
+
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], 1.0)
+                if not ready:
+                    continue
+                try:
+                    data = os.read(fd, 65536)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                changed = set()
+                rescan = False
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                    name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length]
+                    name = name.rstrip(b"\0").decode(sys.getfilesystemencoding(), "replace")
+                    offset += EVENT_HEADER.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        rescan = True
+                    elif wd == root:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            watch_machine(name)
+                        changed.add(name)
+                    elif mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                    elif wd in watches:
+                        changed.add(watches[wd])
+                if rescan:
+                    self.scan()
+                elif changed:
+                    self._update(changed)
+        finally:
+            os.close(fd)
@@ -9,7 +9,7 @@ install_requires = [
 setup(
     name="dockermachinepy",
     version=__version__,
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "tests"]),
     install_requires=install_requires,
     package_data={
         '': ['*.rst'],
@@ -1,8 +1,11 @@
 import unittest
+import io
 import os
+import sys
 import docker
 
 import machine
+from machine.helper import write_table, run_parallel
 
 # machine name used for testing
 TEST_MACHINE = os.environ.get("DOCKER_MACHINE", "python-docker-machine")
@@ -46,6 +49,11 @@ class TestCommands(unittest.TestCase):
         self.assertTrue(client.ping())
 
 
+    def test_client(self):
+        client = self.machine.client(machine=TEST_MACHINE)
+        self.assertTrue(client is self.machine.client(machine=TEST_MACHINE))
+        self.assertTrue(client.ping())
+
     def test_config_invalid_machine(self):
         with self.assertRaises(RuntimeError):
             self.machine.config(machine=INVALID_MACHINE)
@@ -55,8 +63,58 @@ class TestCommands(unittest.TestCase):
         self.machine.create(machine=TEMPORARY_MACHINE)
         self.machine.rm(machine=TEMPORARY_MACHINE)
 
+    @unittest.skip("disabled since it takes ages")
+    def test_create_many(self):
+        names = [TEMPORARY_MACHINE + "-%s" % i for i in range(2)]
+        results = list(self.machine.create_many(names, "none", concurrency=2))
+        self.assertEqual(sorted(x[0] for x in results), names)
+        self.assertTrue(all(x[2] is None for x in results))
+        self.machine.bulk("rm", names)
+
     def test_env(self):
-        self.machine.env(machine=TEST_MACHINE)
+        env = self.machine.env(machine=TEST_MACHINE)
+        self.assertEqual(env["DOCKER_MACHINE_NAME"], TEST_MACHINE)
+
+    def test_scoped_env(self):
+        before = dict(os.environ)
+        with self.machine.scoped_env(machine=TEST_MACHINE) as env:
+            self.assertEqual(env["DOCKER_MACHINE_NAME"], TEST_MACHINE)
+            self.assertEqual(machine.environ.current(), env)
+        self.assertEqual(dict(os.environ), before)
+
+    def test_ssh(self):
+        self.assertEqual(self.machine.ssh(TEST_MACHINE, ["echo", "hello world"]).strip(), "hello world")
+        self.assertEqual(self.machine.ssh(TEST_MACHINE, "cat", input=b"data"), "data")
+        with self.assertRaises(RuntimeError):
+            self.machine.ssh(TEST_MACHINE, "exit 3")
+        session = self.machine.ssh_session(TEST_MACHINE)
+        self.assertIs(self.machine.ssh_session(TEST_MACHINE), session)
+        self.assertTrue(os.path.exists(session.control_path))
+        self.machine.close_ssh(TEST_MACHINE)
+        self.assertIsNot(self.machine.ssh_session(TEST_MACHINE), session)
+
+    def test_run_on(self):
+        run = self.machine.run_on([TEST_MACHINE, INVALID_MACHINE], "echo out; echo err >&2; exit 3")
+        events = list(run)
+        self.assertEqual(sorted((x[0], x[1], x[2]) for x in events),
+                         [(TEST_MACHINE, "stderr", "err"), (TEST_MACHINE, "stdout", "out")])
+        self.assertEqual(run.returncodes, {TEST_MACHINE: 3})
+        self.assertIsInstance(run.errors[INVALID_MACHINE], machine.errors.MachineNotFoundError)
+        returncodes, errors = self.machine.run_on([TEST_MACHINE], "sleep 10", timeout=1).wait()
+        self.assertEqual(returncodes, {})
+        self.assertIsInstance(errors[TEST_MACHINE], machine.errors.CommandTimeoutError)
+
+    def test_put_get(self):
+        path = "/tmp/python-docker-machine-test"
+        data = os.urandom(300 * 1024)
+        self.assertEqual(self.machine.put(TEST_MACHINE, memoryview(data), path), len(data))
+        with self.machine.get(TEST_MACHINE, path) as stream:
+            self.assertEqual(stream.read(), data)
+        self.machine.put(TEST_MACHINE, io.BytesIO(b"hello"), path)
+        with self.machine.get(TEST_MACHINE, path) as stream:
+            self.assertEqual(stream.read(), b"hello")
+        with self.assertRaises(RuntimeError):
+            self.machine.get(TEST_MACHINE, path + "-missing").read()
 
     def test_inspect(self):
         self.machine.inspect(machine=TEST_MACHINE)
@@ -64,15 +122,100 @@ class TestCommands(unittest.TestCase):
     def test_ip(self):
         self.machine.ip(machine=TEST_MACHINE)
 
+    def test_store(self):
+        m = machine.Machine(store=machine.FileStore())
+        self.assertTrue(m.exists(machine=TEST_MACHINE))
+        self.assertEqual(m.inspect(machine=TEST_MACHINE)["Name"], TEST_MACHINE)
+        self.assertEqual(m.url(machine=TEST_MACHINE), self.machine.url(machine=TEST_MACHINE))
+
+    def test_bulk(self):
+        results, errors = self.machine.bulk("status", [TEST_MACHINE, INVALID_MACHINE])
+        self.assertTrue(results[TEST_MACHINE])
+        self.assertTrue(isinstance(errors[INVALID_MACHINE], machine.errors.MachineNotFoundError))
+
     def test_kill(self):
         self.machine.kill(machine=TEST_MACHINE)
 
     def test_ls(self):
         self.machine.ls()
 
+    def test_ls_filters(self):
+        machines = self.machine.ls(pprint=False, filters={"name": TEST_MACHINE, "State": "Running"})
+        self.assertEqual([x["Name"] for x in machines], [TEST_MACHINE])
+        for filters in ({"name": TEST_MACHINE, "state": machine.State.RUNNING},
+                        {"name": TEST_MACHINE, "State": machine.State.RUNNING}):
+            machines = self.machine.ls(pprint=False, filters=filters)
+            self.assertEqual([x["Name"] for x in machines], [TEST_MACHINE])
+
+    def test_iter_ls(self):
+        records = dict((x.name, x) for x in self.machine.iter_ls())
+        self.assertTrue(TEST_MACHINE in records)
+        self.assertTrue(isinstance(records[TEST_MACHINE].active_swarm, bool))
+
+    def test_write_table(self):
+        stream = io.StringIO()
+        write_table(self.machine.iter_ls(), ["name", "state"], fmt="tsv", stream=stream)
+        self.assertTrue(stream.getvalue().startswith(u"name\tstate\n"))
+
+    def test_cache(self):
+        m = machine.Machine()
+        ip = m.ip(machine=TEST_MACHINE)
+        self.assertEqual(m.ip(machine=TEST_MACHINE), ip)
+        self.assertEqual(m.cache_info().hits, 1)
+        m.restart(machine=TEST_MACHINE)
+        m.ip(machine=TEST_MACHINE)
+        self.assertEqual(m.cache_info().misses, 2)
+
+    def test_hooks(self):
+        events = []
+
+        class Recorder(machine.Hooks):
+            def on_start(self, trace):
+                events.append(("start", trace.pid))
+
+            def on_finish(self, trace):
+                events.append(("finish", trace.returncode))
+
+        m = machine.Machine(hooks=[Recorder()])
+        m.version()
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[0][1] is not None)
+        self.assertEqual(events[1], ("finish", 0))
+
+    def test_metrics(self):
+        m = machine.Machine()
+        m.ls(pprint=False)
+        snapshot = m.metrics.snapshot()
+        self.assertEqual(snapshot["commands"]["ls"], 1)
+        self.assertEqual(snapshot["in_flight"]["ls"], 0)
+        self.assertTrue(snapshot["stdout_bytes"]["ls"] > 0)
+        self.assertTrue('docker_machine_commands_total{verb="ls"} 1' in m.metrics.prometheus())
+
+    def test_singleflight(self):
+        calls = list(run_parallel(lambda _: self.machine.ip(machine=TEST_MACHINE), range(10)))
+        self.assertEqual([error for _, _, error in calls], [None] * 10)
+        self.assertEqual(len(set(result for _, result, _ in calls)), 1)
+
+    def test_index(self):
+        self.assertTrue(TEST_MACHINE in self.machine)
+        self.assertFalse(INVALID_MACHINE in self.machine)
+        self.machine.invalidate_index()
+        self.assertTrue(self.machine.exists(machine=TEST_MACHINE))
+
     def test_provision(self):
         self.machine.provision(machine=TEST_MACHINE)
 
+    def test_provision_callback(self):
+        lines = []
+        self.machine.provision(machine=TEST_MACHINE, callback=lambda *event: lines.append(event))
+        self.assertTrue(lines)
+
+    def test_stream(self):
+        process = self.machine.stream(["ip", TEST_MACHINE])
+        events = list(process)
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(events[0][0], "stdout")
+
     def test_regenerate_certs(self):
         self.machine.regenerate_certs(machine=TEST_MACHINE)
 
@@ -97,6 +240,36 @@ class TestCommands(unittest.TestCase):
         self.machine.stop(machine=TEST_MACHINE)
         self.assertFalse(self.machine.status(machine=TEST_MACHINE))
 
+    def test_status_many(self):
+        states = self.machine.status_many([TEST_MACHINE, INVALID_MACHINE])
+        self.assertEqual(list(states), [TEST_MACHINE])
+        self.assertEqual(states[TEST_MACHINE], machine.State.RUNNING)
+
+    def test_monitor(self):
+        m = machine.Machine()
+        monitor = m.monitor()
+        try:
+            monitor.refresh()
+            self.assertTrue(TEST_MACHINE in monitor.snapshot())
+            self.assertTrue(m.status(machine=TEST_MACHINE))
+            m.invalidate_states()
+            self.assertIsNone(monitor.snapshot())
+            self.assertTrue(m.status(machine=TEST_MACHINE))
+            monitor.refresh()
+            self.assertTrue(TEST_MACHINE in monitor.snapshot())
+        finally:
+            m.stop_monitor()
+
+    def test_watch(self):
+        m = machine.Machine()
+        watcher = m.watch()
+        try:
+            self.assertTrue(TEST_MACHINE in watcher.names())
+            self.assertTrue(TEST_MACHINE in m)
+            self.assertEqual(watcher.scan(), [])
+        finally:
+            m.stop_watch()
+
     def test_status_when_invalid_machine(self):
         with self.assertRaises(RuntimeError):
             self.machine.status(machine=INVALID_MACHINE)
@@ -105,11 +278,21 @@ class TestCommands(unittest.TestCase):
         self.machine.stop(machine=TEST_MACHINE)
         self.assertFalse(self.machine.status(machine=TEST_MACHINE))
 
+    def test_stop_many(self):
+        results, errors = self.machine.stop_many([TEST_MACHINE, INVALID_MACHINE])
+        self.assertTrue(results[TEST_MACHINE])
+        self.assertTrue(INVALID_MACHINE in errors)
+        self.assertFalse(self.machine.status(machine=TEST_MACHINE))
+
     def test_stop_when_stopped(self):
         self.machine.stop(machine=TEST_MACHINE)
         with self.assertRaises(RuntimeError):
             self.machine.stop(machine=TEST_MACHINE)
 
+    def test_timeout(self):
+        with self.assertRaises(machine.errors.CommandTimeoutError):
+            self.machine.provision(machine=TEST_MACHINE, timeout=0.001)
+
     def test_upgrade(self):
         self.machine.upgrade(machine=TEST_MACHINE)
 
@@ -118,3 +301,49 @@ class TestCommands(unittest.TestCase):
 
     def test_version(self):
         version = self.machine.version()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio API needs python 3.5")
+class TestAsyncCommands(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        # futures built outside a coroutine (asyncio.gather) bind to the
+        # current loop, it must be self.loop
+        asyncio.set_event_loop(self.loop)
+        self.machine = machine.AsyncMachine(timeout=60)
+
+    def tearDown(self):
+        import asyncio
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_status(self):
+        self.assertTrue(self.run_async(self.machine.status(machine=TEST_MACHINE)))
+
+    def test_ls(self):
+        machines = self.run_async(self.machine.ls(pprint=False))
+        self.assertTrue(TEST_MACHINE in [x["Name"] for x in machines])
+
+    def test_singleflight(self):
+        import asyncio
+        urls = self.run_async(asyncio.gather(
+            *[self.machine.url(machine=TEST_MACHINE) for _ in range(10)]))
+        self.assertEqual(len(set(urls)), 1)
+
+    def test_status_when_invalid_machine(self):
+        with self.assertRaises(machine.errors.MachineNotFoundError):
+            self.run_async(self.machine.status(machine=INVALID_MACHINE))
+
+    def test_env(self):
+        env = self.run_async(self.machine.env(machine=TEST_MACHINE))
+        self.assertEqual(env["DOCKER_MACHINE_NAME"], TEST_MACHINE)
+        self.assertEqual(self.run_async(self.machine.env(machine=TEST_MACHINE)), env)
+        self.assertEqual(self.machine.cache_info().hits, 1)
+
+    def test_timeout(self):
+        with self.assertRaises(machine.errors.CommandTimeoutError):
+            self.run_async(self.machine.provision(machine=TEST_MACHINE, timeout=0.001))